@@ -0,0 +1,233 @@
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, Any, Optional
+from PIL import Image
+
+# Cost model: one work unit per page for decoding plus a share for the
+# rasterized pixel area (memory and vision-encoder time scale with it).
+PAGE_COST = 1.0
+MEGAPIXEL_COST = 0.1
+BASE_DPI = 300
+
+# Text documents are rendered onto a fixed 800x1000 canvas by DocumentProcessor.
+TEXT_PAGE_PIXELS = 800 * 1000
+
+# Relative cost multiplier per file type.
+FILE_TYPE_WEIGHTS = {
+    '.pdf': 1.0,
+    '.png': 1.0,
+    '.jpg': 1.0,
+    '.jpeg': 1.0,
+    '.docx': 0.8,
+    '.txt': 0.8,
+}
+
+# File types whose rasterization honours a reduced resolution. Text documents
+# are always rendered onto the same canvas, so they cannot be downgraded.
+DOWNGRADABLE_TYPES = {'.pdf', '.png', '.jpg', '.jpeg'}
+
+# A4 at 300 dpi, used when the page geometry cannot be read.
+DEFAULT_PAGE_PIXELS = 2480 * 3508
+
+# Drain rate is completed cost over busy time, both decayed by this factor per
+# completion; the configured initial rate counts as this many busy seconds.
+DRAIN_DECAY = 0.9
+DRAIN_PRIOR_SECONDS = 30.0
+
+
+@dataclass
+class JobEstimate:
+    pages: int
+    pixels: int
+    file_type: str
+    cost: float
+
+    def scaled_cost(self, resolution_scale: float) -> float:
+        """Cost of the job when rasterized at a reduced resolution"""
+        weight = FILE_TYPE_WEIGHTS.get(self.file_type, 1.0)
+        megapixels = self.pixels * resolution_scale ** 2 / 1_000_000
+        return weight * (self.pages * PAGE_COST + megapixels * MEGAPIXEL_COST)
+
+
+    def remaining(self, completed_pages: int) -> "JobEstimate":
+        """Estimate for the pages still to be processed when resuming a job"""
+        pages = max(self.pages - completed_pages, 0)
+        fraction = pages / self.pages if self.pages else 0.0
+        estimate = JobEstimate(
+            pages=pages, pixels=int(self.pixels * fraction), file_type=self.file_type, cost=0.0
+        )
+        estimate.cost = estimate.scaled_cost(1.0)
+        return estimate
+
+
+@dataclass
+class AdmissionDecision:
+    admitted: bool
+    cost: float = 0.0
+    resolution_scale: float = 1.0
+    retry_after: int = 0
+    # Rejected because the job alone exceeds the per-job cost limit
+    oversized: bool = False
+
+    @property
+    def downgraded(self) -> bool:
+        return self.admitted and self.resolution_scale < 1.0
+
+
+class AdmissionController:
+    """Tracks in-flight extraction work and decides whether new jobs may start.
+
+    Below the soft watermark jobs run at full resolution. Between the soft and
+    hard watermarks they are downgraded to a cheaper resolution. Above the hard
+    watermark they are rejected with a Retry-After derived from the observed
+    drain rate. A job whose cost exceeds the per-job limit even at reduced
+    resolution is never admitted, however idle the server is.
+    """
+
+    def __init__(
+        self,
+        soft_watermark: float = float(os.environ.get("KIE_ADMISSION_SOFT_WATERMARK", 20)),
+        hard_watermark: float = float(os.environ.get("KIE_ADMISSION_HARD_WATERMARK", 40)),
+        downgrade_scale: float = float(os.environ.get("KIE_ADMISSION_DOWNGRADE_SCALE", 0.5)),
+        initial_drain_rate: float = float(os.environ.get("KIE_ADMISSION_DRAIN_RATE", 0.2)),
+        max_retry_after: int = int(os.environ.get("KIE_ADMISSION_MAX_RETRY_AFTER", 300)),
+        max_job_cost: float = float(os.environ.get("KIE_ADMISSION_MAX_JOB_COST", 100)),
+    ):
+        self.soft_watermark = soft_watermark
+        self.hard_watermark = hard_watermark
+        self.downgrade_scale = downgrade_scale
+        self.max_retry_after = max_retry_after
+        self.max_job_cost = max_job_cost
+        # Decayed sums of completed work units and of seconds the server was busy
+        self._completed_cost = initial_drain_rate * DRAIN_PRIOR_SECONDS
+        self._busy_seconds = DRAIN_PRIOR_SECONDS
+        self._busy_since: Optional[float] = None
+        self.in_flight_cost = 0.0
+        self.in_flight_jobs = 0
+        self.rejected_jobs = 0
+        self.downgraded_jobs = 0
+        self.oversized_jobs = 0
+
+    @property
+    def drain_rate(self) -> float:
+        """Work units completed per busy second"""
+        return self._completed_cost / self._busy_seconds
+
+    def estimate(self, file_path: str) -> JobEstimate:
+        """Estimate the cost of a file from its page count, pixel area and type"""
+        file_type = os.path.splitext(file_path)[1].lower()
+
+        if file_type == '.pdf':
+            pages, pixels = self._pdf_geometry(file_path)
+        elif file_type in {'.png', '.jpg', '.jpeg'}:
+            try:
+                with Image.open(file_path) as image:
+                    width, height = image.size
+                pages, pixels = 1, width * height
+            except Exception:
+                pages, pixels = 1, DEFAULT_PAGE_PIXELS
+        else:
+            pages, pixels = 1, TEXT_PAGE_PIXELS
+
+        estimate = JobEstimate(pages=pages, pixels=pixels, file_type=file_type, cost=0.0)
+        estimate.cost = estimate.scaled_cost(1.0)
+        return estimate
+
+    def _pdf_geometry(self, file_path: str):
+        from pdf2image import pdfinfo_from_path
+
+        try:
+            info = pdfinfo_from_path(file_path)
+        except Exception:
+            return 1, DEFAULT_PAGE_PIXELS
+
+        pages = max(int(info.get("Pages", 1)), 1)
+        page_pixels = DEFAULT_PAGE_PIXELS
+
+        # pdfinfo reports the first page size as e.g. "595.276 x 841.89 pts (A4)"
+        size_match = re.match(r'\s*([\d.]+)\s*x\s*([\d.]+)\s*pts', str(info.get("Page size", "")))
+        if size_match:
+            width_pts, height_pts = float(size_match.group(1)), float(size_match.group(2))
+            page_pixels = int(width_pts / 72 * BASE_DPI) * int(height_pts / 72 * BASE_DPI)
+
+        return pages, pages * page_pixels
+
+    def _retry_after(self, cost: float) -> int:
+        excess = self.in_flight_cost + cost - self.hard_watermark
+        seconds = excess / max(self.drain_rate, 1e-3)
+        return int(min(max(seconds, 1), self.max_retry_after))
+
+    def check_capacity(self) -> AdmissionDecision:
+        """Cheap check for endpoints that only enqueue work, such as uploads"""
+        if self.in_flight_cost >= self.hard_watermark:
+            self.rejected_jobs += 1
+            return AdmissionDecision(admitted=False, retry_after=self._retry_after(0.0))
+        return AdmissionDecision(admitted=True)
+
+    def admit(self, estimate: JobEstimate) -> AdmissionDecision:
+        full_cost = estimate.cost
+        downgrade_scale = self.downgrade_scale if estimate.file_type in DOWNGRADABLE_TYPES else 1.0
+        reduced_cost = estimate.scaled_cost(downgrade_scale)
+
+        if reduced_cost > self.max_job_cost:
+            # All pages are rasterized into memory at once, so a job this large
+            # is refused outright rather than queued or retried
+            self.oversized_jobs += 1
+            return AdmissionDecision(admitted=False, cost=reduced_cost, oversized=True)
+
+        if self.in_flight_cost + full_cost <= self.soft_watermark:
+            decision = AdmissionDecision(admitted=True, cost=full_cost)
+        elif self.in_flight_cost + reduced_cost <= self.hard_watermark or self.in_flight_jobs == 0:
+            # A job above the hard watermark (but within the per-job limit) still
+            # runs on an idle server, at reduced resolution, so that it cannot be
+            # starved forever.
+            decision = AdmissionDecision(
+                admitted=True, cost=reduced_cost, resolution_scale=downgrade_scale
+            )
+            if decision.downgraded:
+                self.downgraded_jobs += 1
+        else:
+            self.rejected_jobs += 1
+            return AdmissionDecision(admitted=False, retry_after=self._retry_after(reduced_cost))
+
+        if self.in_flight_jobs == 0:
+            # Idle time before this job does not count towards the drain rate
+            self._busy_since = time.monotonic()
+        self.in_flight_cost += decision.cost
+        self.in_flight_jobs += 1
+        return decision
+
+    def release(self, decision: AdmissionDecision, elapsed_seconds: Optional[float] = None):
+        """Return an admitted job's work to the pool and update the drain rate"""
+        if not decision.admitted:
+            return
+
+        concurrent_jobs = max(self.in_flight_jobs, 1)
+        self.in_flight_cost = max(self.in_flight_cost - decision.cost, 0.0)
+        self.in_flight_jobs = max(self.in_flight_jobs - 1, 0)
+
+        now = time.monotonic()
+        busy_interval = now - self._busy_since if self._busy_since is not None else 0.0
+        self._busy_since = now if self.in_flight_jobs else None
+
+        if elapsed_seconds and elapsed_seconds > 0:
+            # Jobs finishing back to back share almost no busy time, so the
+            # interval is floored at this job's share of its own runtime.
+            interval = max(busy_interval, elapsed_seconds / concurrent_jobs)
+            self._completed_cost = DRAIN_DECAY * self._completed_cost + decision.cost
+            self._busy_seconds = DRAIN_DECAY * self._busy_seconds + interval
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight_cost": round(self.in_flight_cost, 3),
+            "in_flight_jobs": self.in_flight_jobs,
+            "soft_watermark": self.soft_watermark,
+            "hard_watermark": self.hard_watermark,
+            "max_job_cost": self.max_job_cost,
+            "drain_rate": round(self.drain_rate, 4),
+            "rejected_jobs": self.rejected_jobs,
+            "downgraded_jobs": self.downgraded_jobs,
+            "oversized_jobs": self.oversized_jobs,
+        }
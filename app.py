@@ -1,16 +1,22 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query
 from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel
 import aiofiles
 import os
 import uuid
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import asyncio
-from datetime import datetime
+import time
+from datetime import date, datetime
 
 from document_processor import DocumentProcessor
-from nanonets_extractor import NanoNetsExtractor
+from admission_control import AdmissionController
+from declaration_index import DeclarationIndex
+from remapper import Remapper
+from document_classifier import classify_text, output_formats
+from job_checkpoint import JobCheckpoint, remove_stale_checkpoints
 
 app = FastAPI(title="KIE Document Processing API", version="1.0.0")
 
@@ -24,15 +30,60 @@ app.add_middleware(
 
 UPLOAD_DIR = "uploads"
 RESULTS_DIR = "results"
+CHECKPOINT_DIR = os.path.join(RESULTS_DIR, "checkpoints")
+# Attempts per page within one extraction request, with exponential backoff
+PAGE_MAX_ATTEMPTS = int(os.environ.get("KIE_PAGE_MAX_ATTEMPTS", 3))
+PAGE_RETRY_BACKOFF = float(os.environ.get("KIE_PAGE_RETRY_BACKOFF", 1.0))
+# Attempts per page across all requests for a job; then the page is given up
+PAGE_MAX_TOTAL_ATTEMPTS = int(os.environ.get("KIE_PAGE_MAX_TOTAL_ATTEMPTS", 3 * PAGE_MAX_ATTEMPTS))
+# Checkpoints of failed or partial jobs are removed after this long without progress
+CHECKPOINT_TTL_HOURS = float(os.environ.get("KIE_CHECKPOINT_TTL_HOURS", 168))
+# Classify each page first and extract with a type-specific prompt and mapping
+CLASSIFY_DOCUMENTS = os.environ.get("KIE_CLASSIFY_DOCUMENTS", "1") == "1"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(RESULTS_DIR, exist_ok=True)
+os.makedirs(CHECKPOINT_DIR, exist_ok=True)
 
 processor = DocumentProcessor()
-extractor = NanoNetsExtractor()
+
+# "stub" replaces model inference with a fixed delayed response, for load testing
+if os.environ.get("KIE_MODEL_BACKEND", "nanonets") == "stub":
+    from stub_extractor import StubExtractor
+    extractor = StubExtractor()
+else:
+    from nanonets_extractor import NanoNetsExtractor
+    extractor = NanoNetsExtractor()
+
+admission = AdmissionController()
+declaration_index = DeclarationIndex(os.path.join(RESULTS_DIR, "declarations.db"))
+remapper = Remapper(RESULTS_DIR)
+
+# Jobs currently being extracted, so a retry cannot run the same pages twice
+active_jobs = set()
+
+class RemapRequest(BaseModel):
+    job_ids: Optional[List[str]] = None
+    force: bool = False
+
+def _overloaded(retry_after: int) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Server is overloaded, retry later",
+        headers={"Retry-After": str(retry_after)}
+    )
 
 @app.on_event("startup")
 async def startup_event():
     await extractor.initialize()
+    
+    # Index result files written before the index existed, without blocking startup
+    loop = asyncio.get_event_loop()
+    loop.run_in_executor(None, declaration_index.backfill, RESULTS_DIR)
+    _remove_stale_checkpoints()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    remapper.shutdown()
 
 @app.get("/", response_class=HTMLResponse)
 async def serve_frontend():
@@ -45,6 +96,10 @@ async def upload_file(file: UploadFile = File(...)):
     if not file.filename:
         raise HTTPException(status_code=400, detail="No file provided")
     
+    capacity = admission.check_capacity()
+    if not capacity.admitted:
+        raise _overloaded(capacity.retry_after)
+    
     allowed_extensions = {'.pdf', '.png', '.jpg', '.jpeg', '.docx', '.txt'}
     file_extension = os.path.splitext(file.filename)[1].lower()
     
@@ -63,50 +118,213 @@ async def upload_file(file: UploadFile = File(...)):
     
     return {"job_id": job_id, "filename": file.filename, "status": "uploaded"}
 
+async def _extract_page(image, page_text) -> Dict[str, Any]:
+    document_class = None
+    if CLASSIFY_DOCUMENTS:
+        # The text layer is free when present; otherwise ask the model on a thumbnail
+        document_class = classify_text(page_text) or await extractor.classify_document(image)
+    
+    extracted_data = await extractor.extract_key_value_pairs(image, document_class)
+    
+    combined_result = {"raw_extraction": extracted_data}
+    if document_class:
+        combined_result["document_class"] = document_class
+    
+    # Only build the output formats relevant to the document type
+    formats = output_formats(document_class)
+    if "customs_format" in formats:
+        combined_result["customs_format"] = extractor.extract_customs_fields(extracted_data)
+    if "invoice_format" in formats:
+        combined_result["invoice_format"] = extractor.extract_invoice_fields(extracted_data)
+    
+    return combined_result
+
+def _exhausted_page(checkpoint: JobCheckpoint, page_number: int) -> Dict[str, Any]:
+    # Placeholder that keeps later pages at their position in extracted_data
+    return {
+        "exhausted": True,
+        "error": checkpoint.error(page_number),
+        "attempts": checkpoint.attempts(page_number)
+    }
+
+def _remove_stale_checkpoints():
+    loop = asyncio.get_event_loop()
+    loop.run_in_executor(
+        None, remove_stale_checkpoints, CHECKPOINT_DIR, CHECKPOINT_TTL_HOURS * 3600, set(active_jobs)
+    )
+
 @app.post("/extract/{job_id}", response_model=Dict[str, Any])
-async def extract_document(job_id: str):
+async def extract_document(job_id: str, retry_exhausted: bool = False):
     upload_files = [f for f in os.listdir(UPLOAD_DIR) if f.startswith(job_id)]
     
     if not upload_files:
         raise HTTPException(status_code=404, detail="Job ID not found")
     
-    file_path = os.path.join(UPLOAD_DIR, upload_files[0])
+    if job_id in active_jobs:
+        raise HTTPException(status_code=409, detail="Extraction already in progress")
+    
+    # Claimed before the first await, so a concurrent retry cannot slip past the check
+    active_jobs.add(job_id)
+    try:
+        return await _run_extraction(job_id, os.path.join(UPLOAD_DIR, upload_files[0]), retry_exhausted)
+    finally:
+        active_jobs.discard(job_id)
+        _remove_stale_checkpoints()
+
+async def _run_extraction(job_id: str, file_path: str, retry_exhausted: bool = False) -> Dict[str, Any]:
+    # Pages finished by an earlier, interrupted or failed run are not extracted again
+    loop = asyncio.get_event_loop()
+    checkpoint = await loop.run_in_executor(None, JobCheckpoint, CHECKPOINT_DIR, job_id)
+    if retry_exhausted:
+        await loop.run_in_executor(None, checkpoint.reset_exhausted)
+    completed_pages = set(await loop.run_in_executor(None, checkpoint.completed_pages))
+    
+    estimate = await loop.run_in_executor(None, admission.estimate, file_path)
+    estimate = estimate.remaining(len(completed_pages))
+    decision = admission.admit(estimate)
+    if decision.oversized:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Document too large: estimated cost {decision.cost:.1f} exceeds the "
+                   f"per-job limit of {admission.max_job_cost:g}"
+        )
+    if not decision.admitted:
+        raise _overloaded(decision.retry_after)
     
+    started = time.monotonic()
     try:
-        processed_images = await processor.process_file(file_path)
+        processed_images = await processor.process_file(file_path, decision.resolution_scale)
+        await loop.run_in_executor(None, checkpoint.start, len(processed_images))
+        
+        text_pages = await processor.extract_text_pages(file_path) if CLASSIFY_DOCUMENTS else []
         
         results = []
-        for image in processed_images:
-            extracted_data = await extractor.extract_key_value_pairs(image)
+        failed_pages = {}
+        exhausted_pages = []
+        for page_number, image in enumerate(processed_images):
+            if page_number in completed_pages:
+                page_result = await loop.run_in_executor(None, checkpoint.load_page, page_number)
+                if page_result is not None:
+                    results.append(page_result)
+                    continue
+            
+            # Pages that used up their attempts in earlier runs are not paid for again
+            if checkpoint.is_exhausted(page_number) or checkpoint.attempts(page_number) >= PAGE_MAX_TOTAL_ATTEMPTS:
+                await loop.run_in_executor(None, checkpoint.mark_exhausted, page_number)
+                exhausted_pages.append(page_number)
+                results.append(_exhausted_page(checkpoint, page_number))
+                continue
             
-            # Enhanced processing with customs field mapping
-            customs_data = extractor.extract_customs_fields(extracted_data)
+            page_text = text_pages[page_number] if page_number < len(text_pages) else None
+            page_result = None
+            for attempt in range(PAGE_MAX_ATTEMPTS):
+                try:
+                    page_result = await _extract_page(image, page_text)
+                    break
+                except Exception as e:
+                    total_attempts = await loop.run_in_executor(
+                        None, checkpoint.record_failure, page_number, str(e)
+                    )
+                    failed_pages[page_number] = str(e)
+                    if total_attempts >= PAGE_MAX_TOTAL_ATTEMPTS:
+                        await loop.run_in_executor(None, checkpoint.mark_exhausted, page_number)
+                        exhausted_pages.append(page_number)
+                        break
+                    if attempt + 1 < PAGE_MAX_ATTEMPTS:
+                        await asyncio.sleep(PAGE_RETRY_BACKOFF * 2 ** attempt)
             
-            # Combine both formats for flexibility
-            combined_result = {
-                "raw_extraction": extracted_data,
-                "customs_format": customs_data,
-                "invoice_format": extractor.extract_invoice_fields(extracted_data)
-            }
+            if page_result is None:
+                if page_number in exhausted_pages:
+                    results.append(_exhausted_page(checkpoint, page_number))
+                # Keep going so the remaining pages are checkpointed too
+                continue
             
-            results.append(combined_result)
+            failed_pages.pop(page_number, None)
+            await loop.run_in_executor(None, checkpoint.save_page, page_number, page_result)
+            results.append(page_result)
+        
+        retryable = sorted(set(failed_pages) - set(exhausted_pages))
+        if retryable:
+            await loop.run_in_executor(None, checkpoint.finish, "failed")
+            messages = [
+                f"pages {', '.join(map(str, retryable))} failed after {PAGE_MAX_ATTEMPTS} attempts "
+                f"and are retried on the next request"
+            ]
+            if exhausted_pages:
+                messages.append(
+                    f"pages {', '.join(map(str, sorted(exhausted_pages)))} failed permanently after "
+                    f"{PAGE_MAX_TOTAL_ATTEMPTS} attempts and are not retried unless "
+                    f"retry_exhausted is set"
+                )
+            raise HTTPException(
+                status_code=500,
+                detail=f"Extraction failed: {'; '.join(messages)}; completed pages are kept"
+            )
         
         result_data = {
             "job_id": job_id,
             "timestamp": datetime.now().isoformat(),
             "extracted_data": results,
-            "status": "completed"
+            "admission": {
+                "estimated_pages": estimate.pages,
+                "estimated_cost": round(decision.cost, 3),
+                "resolution_scale": decision.resolution_scale,
+                "downgraded": decision.downgraded
+            },
+            "resumed_pages": len(completed_pages),
+            "mapping_version": extractor.mapping_version(),
+            # Partial when pages were given up on; they hold an error instead of a result
+            "status": "partial" if exhausted_pages else "completed"
         }
+        if exhausted_pages:
+            result_data["exhausted_pages"] = sorted(exhausted_pages)
         
         result_file = os.path.join(RESULTS_DIR, f"{job_id}_results.json")
         async with aiofiles.open(result_file, 'w') as f:
             import json
             await f.write(json.dumps(result_data, indent=2))
         
+        if exhausted_pages:
+            # Kept so that ?retry_exhausted=true reuses the completed pages
+            await loop.run_in_executor(None, checkpoint.finish, "partial")
+        else:
+            await loop.run_in_executor(None, checkpoint.clear)
+        
+        try:
+            await loop.run_in_executor(None, declaration_index.index_result, result_data)
+        except Exception as e:
+            print(f"Indexing job {job_id} failed: {e}")
+        
         return result_data
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Extraction failed: {str(e)}")
+    finally:
+        admission.release(decision, time.monotonic() - started)
+
+@app.get("/status/{job_id}", response_model=Dict[str, Any])
+async def get_job_status(job_id: str):
+    """Progress of an extraction job, including pages kept from interrupted runs"""
+    if os.path.exists(os.path.join(RESULTS_DIR, f"{job_id}_results.json")) and job_id not in active_jobs:
+        result_data = await get_results(job_id)
+        status = {"job_id": job_id, "status": result_data.get("status", "completed")}
+        if result_data.get("exhausted_pages"):
+            status["exhausted_pages"] = result_data["exhausted_pages"]
+        return status
+    
+    loop = asyncio.get_event_loop()
+    checkpoint = await loop.run_in_executor(None, JobCheckpoint, CHECKPOINT_DIR, job_id)
+    status = await loop.run_in_executor(None, checkpoint.status)
+    if status["status"] == "new":
+        if not any(f.startswith(job_id) for f in os.listdir(UPLOAD_DIR)):
+            raise HTTPException(status_code=404, detail="Job ID not found")
+        status["status"] = "uploaded"
+    elif status["status"] == "in_progress" and job_id not in active_jobs:
+        # Left behind by a crash or restart; the next /extract call resumes it
+        status["status"] = "interrupted"
+    return status
 
 @app.get("/results/{job_id}", response_model=Dict[str, Any])
 async def get_results(job_id: str):
@@ -120,10 +338,67 @@ async def get_results(job_id: str):
         content = await f.read()
         return json.loads(content)
 
+@app.post("/remap", response_model=Dict[str, Any])
+async def remap_results(request: RemapRequest):
+    """Rebuild customs/invoice formats of stored jobs from their raw extraction.
+    
+    Without job_ids every stored job is remapped; an empty list remaps none. Jobs already at the current
+    mapping version are skipped unless force is set.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None, lambda: remapper.remap(request.job_ids, request.force, declaration_index)
+    )
+
+@app.post("/remap/{job_id}", response_model=Dict[str, Any])
+async def remap_result(job_id: str, force: bool = False):
+    loop = asyncio.get_event_loop()
+    summary = await loop.run_in_executor(
+        None, lambda: remapper.remap([job_id], force, declaration_index)
+    )
+    if summary["failed"]:
+        error = summary["failed"][0]["error"]
+        raise HTTPException(status_code=404 if error == "Results not found" else 500, detail=error)
+    return await get_results(job_id)
+
+@app.get("/search", response_model=Dict[str, Any])
+async def search_declarations(
+    lrn: Optional[str] = None,
+    mrn: Optional[str] = None,
+    eori: Optional[str] = None,
+    party: Optional[str] = None,
+    date_from: Optional[date] = Query(None, description="ISO date (YYYY-MM-DD), inclusive"),
+    date_to: Optional[date] = Query(None, description="ISO date (YYYY-MM-DD), inclusive"),
+    document_type: Optional[str] = None,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(50, ge=1, le=500)
+):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None,
+        lambda: declaration_index.search(
+            lrn=lrn, mrn=mrn, eori=eori, party=party,
+            date_from=date_from, date_to=date_to, document_type=document_type,
+            page=page, page_size=page_size
+        )
+    )
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
+@app.get("/admission")
+async def admission_status():
+    return admission.stats()
+
+@app.get("/decoding")
+async def decoding_status():
+    return extractor.decoding_stats()
+
+@app.get("/cache")
+async def vision_cache_status():
+    return extractor.vision_cache_stats()
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Not runnable directly: remap worker processes re-import __main__, see server.py
+    raise SystemExit("Start the API server with: python server.py")
\ No newline at end of file
@@ -0,0 +1,348 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import date, datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+from document_classifier import parse_label
+
+# Keys in the raw extraction that name a party to the declaration
+PARTY_KEYS = (
+    'anmelder', 'ausfuhrer', 'ausführer', 'empfanger', 'empfänger', 'versender',
+    'beforderer', 'beförderer', 'vertreter', 'declarant', 'exporter', 'consignee',
+    'consignor', 'carrier', 'representative', 'vendor', 'seller', 'customer', 'buyer',
+)
+
+# Identifier kinds and the key fragments they are recognised by
+IDENTIFIER_KEYS = {
+    'lrn': ('lrn', 'local_reference', 'lokale_referenz'),
+    'mrn': ('mrn', 'movement_reference', 'bearbeitungsnummer'),
+    'eori': ('eori',),
+}
+
+# Keys carrying the declaration date, most specific first; a key matches when
+# it contains the fragment. Due and departure dates are not declaration dates.
+DATE_KEYS = (
+    ('anmeldedatum', 'zeitpunktderanmeldung', 'zeitpunkt_der_anmeldung', 'declaration_date'),
+    ('datum', 'date'),
+)
+EXCLUDED_DATE_KEYS = ('due', 'faellig', 'fällig', 'ausgang', 'departure', 'gueltig', 'gültig', 'validity')
+
+DATE_FORMATS = ('%Y-%m-%d', '%d.%m.%Y', '%d/%m/%Y', '%Y%m%d', '%d.%m.%y')
+
+# Bumped when stored rows must be rebuilt; older indexes are dropped and backfilled
+SCHEMA_VERSION = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS declarations (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    document_type TEXT,
+    declaration_date TEXT,
+    job_timestamp TEXT,
+    lrn TEXT,
+    identifiers TEXT,
+    parties TEXT,
+    UNIQUE (job_id, page)
+);
+CREATE INDEX IF NOT EXISTS idx_declarations_date ON declarations (declaration_date);
+CREATE INDEX IF NOT EXISTS idx_declarations_type ON declarations (document_type, declaration_date);
+CREATE TABLE IF NOT EXISTS identifiers (
+    declaration_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_identifiers_lookup ON identifiers (kind, value);
+CREATE INDEX IF NOT EXISTS idx_identifiers_declaration ON identifiers (declaration_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS declaration_fts USING fts5 (
+    parties, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def normalize_identifier(value: Any) -> str:
+    return re.sub(r'\s+', '', str(value)).upper()
+
+
+def normalize_date(value: Any) -> Optional[str]:
+    """Convert a date as written on the document to ISO format, if recognisable"""
+    if not isinstance(value, str):
+        return None
+    text = value.strip()
+    match = re.search(r'\d{4}-\d{2}-\d{2}|\d{1,2}[./]\d{1,2}[./]\d{2,4}|\d{8}', text)
+    if not match:
+        return None
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(match.group(0), date_format).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+class DeclarationIndex:
+    """SQLite index over extraction results for lookup by identifier, party and date"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self._conn.executescript(
+                "DROP TABLE IF EXISTS declarations; DROP TABLE IF EXISTS identifiers; "
+                "DROP TABLE IF EXISTS declaration_fts;"
+            )
+        self._conn.executescript(SCHEMA)
+        self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._conn.commit()
+
+    def _collect(self, page_result: Dict[str, Any]) -> Dict[str, Any]:
+        raw = page_result.get("raw_extraction") or {}
+        customs = page_result.get("customs_format") or {}
+        kopf = customs.get("kopf") or {}
+
+        identifiers = {kind: set() for kind in IDENTIFIER_KEYS}
+        parties = set()
+        dates: List[List[str]] = [[] for _ in DATE_KEYS]
+
+        if kopf.get("lrn"):
+            identifiers['lrn'].add(normalize_identifier(kopf["lrn"]))
+        anmelder = customs.get("anmelder") or {}
+        if anmelder.get("name"):
+            parties.add(str(anmelder["name"]))
+        if anmelder.get("tin"):
+            identifiers['eori'].add(normalize_identifier(anmelder["tin"]))
+
+        def walk(node: Any, key_path: Tuple[str, ...]):
+            if isinstance(node, dict):
+                for key, value in node.items():
+                    walk(value, key_path + (str(key).lower().replace(' ', '_').replace('-', '_'),))
+            elif isinstance(node, list):
+                for item in node:
+                    walk(item, key_path)
+            elif isinstance(node, (str, int)) and str(node).strip() and key_path:
+                key = key_path[-1]
+                for kind, fragments in IDENTIFIER_KEYS.items():
+                    if any(fragment in key for fragment in fragments):
+                        identifiers[kind].add(normalize_identifier(node))
+                        return
+                if not any(excluded in key for excluded in EXCLUDED_DATE_KEYS):
+                    for priority, fragments in enumerate(DATE_KEYS):
+                        iso_date = normalize_date(node) if any(f in key for f in fragments) else None
+                        if iso_date:
+                            dates[priority].append(iso_date)
+                            return
+                in_party = any(party in part for part in key_path for party in PARTY_KEYS)
+                if in_party and (key in ('name', 'firma', 'firmenname', 'company')
+                                 or any(party in key for party in PARTY_KEYS)):
+                    parties.add(str(node).strip())
+
+        walk({
+            key: value for key, value in raw.items()
+            if key not in ("detected_field_patterns", "extraction_metadata")
+        }, ())
+
+        # The model nests dates (e.g. kopf.anmeldedatum), which the customs
+        # mapping only picks up from top-level keys, so the raw extraction wins.
+        declaration_date = next((found[0] for found in dates if found), None) \
+            or normalize_date(kopf.get("zeitpunktderAnmeldung")) \
+            or normalize_date(kopf.get("massgeblichesDatum"))
+
+        # The classifier's label is normalized; the model's free-text type (e.g.
+        # "Handelsrechnung") is only mapped onto the same labels for older results
+        document_type = page_result.get("document_class")
+        if not document_type and raw.get("document_type"):
+            document_type = parse_label(str(raw["document_type"]))
+        return {
+            "document_type": document_type,
+            "declaration_date": declaration_date,
+            "identifiers": {kind: sorted(values) for kind, values in identifiers.items() if values},
+            "parties": sorted(parties),
+        }
+
+    def _index_result(self, result_data: Dict[str, Any]):
+        job_id = result_data["job_id"]
+        self._delete_job(job_id)
+
+        job_timestamp = result_data.get("timestamp")
+        for page, page_result in enumerate(result_data.get("extracted_data") or []):
+            if page_result.get("exhausted"):
+                # Placeholder for a page of a partial result that was never extracted
+                continue
+            entry = self._collect(page_result)
+            lrns = entry["identifiers"].get("lrn") or [None]
+
+            cursor = self._conn.execute(
+                "INSERT INTO declarations (job_id, page, document_type, declaration_date, "
+                "job_timestamp, lrn, identifiers, parties) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id, page, entry["document_type"], entry["declaration_date"], job_timestamp,
+                    lrns[0], json.dumps(entry["identifiers"]), json.dumps(entry["parties"]),
+                )
+            )
+            declaration_id = cursor.lastrowid
+
+            self._conn.executemany(
+                "INSERT INTO identifiers (declaration_id, kind, value) VALUES (?, ?, ?)",
+                [
+                    (declaration_id, kind, value)
+                    for kind, values in entry["identifiers"].items()
+                    for value in values
+                ]
+            )
+            self._conn.execute(
+                "INSERT INTO declaration_fts (rowid, parties) VALUES (?, ?)",
+                (declaration_id, ' | '.join(entry["parties"]))
+            )
+
+    def _delete_job(self, job_id: str):
+        rows = self._conn.execute(
+            "SELECT id FROM declarations WHERE job_id = ?", (job_id,)
+        ).fetchall()
+        for row in rows:
+            self._conn.execute("DELETE FROM identifiers WHERE declaration_id = ?", (row["id"],))
+            self._conn.execute("DELETE FROM declaration_fts WHERE rowid = ?", (row["id"],))
+        self._conn.execute("DELETE FROM declarations WHERE job_id = ?", (job_id,))
+
+    def index_result(self, result_data: Dict[str, Any]):
+        """Index (or re-index) all pages of a stored job result"""
+        with self._lock:
+            try:
+                self._index_result(result_data)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def index_results(self, results: List[Dict[str, Any]]):
+        """Re-index several job results in one transaction"""
+        with self._lock:
+            try:
+                for result_data in results:
+                    self._index_result(result_data)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def backfill(self, results_dir: str) -> int:
+        """Index result files that are not yet in the index"""
+        indexed = 0
+        with self._lock:
+            known = {row[0] for row in self._conn.execute("SELECT DISTINCT job_id FROM declarations")}
+
+        for filename in os.listdir(results_dir):
+            if not filename.endswith("_results.json"):
+                continue
+            job_id = filename[:-len("_results.json")]
+            if job_id in known:
+                continue
+            try:
+                with open(os.path.join(results_dir, filename), 'r') as f:
+                    result_data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                continue
+
+            with self._lock:
+                # Roll back only this file's rows if it cannot be indexed
+                self._conn.execute("SAVEPOINT backfill_file")
+                try:
+                    self._index_result(result_data)
+                except Exception as e:
+                    self._conn.execute("ROLLBACK TO backfill_file")
+                    self._conn.execute("RELEASE backfill_file")
+                    print(f"Skipping {filename} during index backfill: {e}")
+                    continue
+                self._conn.execute("RELEASE backfill_file")
+                indexed += 1
+                if indexed % 1000 == 0:
+                    self._conn.commit()
+
+        with self._lock:
+            self._conn.commit()
+        return indexed
+
+    @staticmethod
+    def _match_expression(text: str) -> str:
+        # Quote every token so user input cannot inject FTS5 query syntax
+        tokens = re.findall(r'\w+', text, re.UNICODE)
+        return ' '.join('"%s"*' % token.replace('"', '""') for token in tokens)
+
+    def search(
+        self,
+        lrn: Optional[str] = None,
+        mrn: Optional[str] = None,
+        eori: Optional[str] = None,
+        party: Optional[str] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        document_type: Optional[str] = None,
+        page: int = 1,
+        page_size: int = 50,
+    ) -> Dict[str, Any]:
+        clauses: List[str] = []
+        params: List[Any] = []
+
+        for kind, value in (('lrn', lrn), ('mrn', mrn), ('eori', eori)):
+            if value:
+                clauses.append(
+                    "d.id IN (SELECT declaration_id FROM identifiers WHERE kind = ? AND value = ?)"
+                )
+                params.extend([kind, normalize_identifier(value)])
+
+        if party:
+            expression = self._match_expression(party)
+            if expression:
+                clauses.append(
+                    "d.id IN (SELECT rowid FROM declaration_fts WHERE declaration_fts MATCH ?)"
+                )
+                params.append("parties : (%s)" % expression)
+
+        if date_from:
+            clauses.append("d.declaration_date >= ?")
+            params.append(date_from.isoformat())
+        if date_to:
+            clauses.append("d.declaration_date <= ?")
+            params.append(date_to.isoformat())
+        if document_type:
+            clauses.append("d.document_type = ?")
+            params.append(document_type.strip().lower())
+
+        where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+        page = max(page, 1)
+        page_size = min(max(page_size, 1), 500)
+
+        with self._lock:
+            total = self._conn.execute(
+                f"SELECT COUNT(*) FROM declarations d {where}", params
+            ).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT d.* FROM declarations d {where} "
+                "ORDER BY d.declaration_date DESC, d.id DESC LIMIT ? OFFSET ?",
+                params + [page_size, (page - 1) * page_size]
+            ).fetchall()
+
+        return {
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "results": [
+                {
+                    "job_id": row["job_id"],
+                    "page": row["page"],
+                    "document_type": row["document_type"],
+                    "declaration_date": row["declaration_date"],
+                    "job_timestamp": row["job_timestamp"],
+                    "lrn": row["lrn"],
+                    "identifiers": json.loads(row["identifiers"]),
+                    "parties": json.loads(row["parties"]),
+                }
+                for row in rows
+            ],
+        }
@@ -0,0 +1,86 @@
+import re
+from typing import Dict, Optional, Tuple
+
+AUSFUHRANMELDUNG = "ausfuhranmeldung"
+INVOICE = "invoice"
+CMR = "cmr"
+OTHER = "other"
+
+DOCUMENT_TYPES = (AUSFUHRANMELDUNG, INVOICE, CMR, OTHER)
+
+# Output formats built for each document type; "other" keeps both
+OUTPUT_FORMATS = {
+    AUSFUHRANMELDUNG: ("customs_format",),
+    INVOICE: ("invoice_format",),
+    CMR: ("customs_format",),
+    OTHER: ("customs_format", "invoice_format"),
+}
+
+# Keywords with weights; strong document titles count more than field labels
+KEYWORDS = {
+    AUSFUHRANMELDUNG: {
+        'ausfuhranmeldung': 3, 'export declaration': 3, 'ausfuhrbegleitdokument': 3,
+        'ausfuhrzollstelle': 2, 'ausgangszollstelle': 2, 'gestellungszollstelle': 2,
+        'mrn': 1, 'lrn': 1, 'anmelder': 1, 'bewilligung': 1, 'warennummer': 1,
+    },
+    INVOICE: {
+        'rechnung': 3, 'invoice': 3, 'rechnungsnummer': 2, 'invoice number': 2,
+        'mwst': 1, 'ust-id': 1, 'vat': 1, 'zahlungsbedingungen': 1, 'payment terms': 1,
+        'gesamtbetrag': 1, 'total amount': 1, 'nettobetrag': 1,
+    },
+    CMR: {
+        'cmr': 3, 'frachtbrief': 3, 'waybill': 3, 'consignment note': 3, 'bill of lading': 3,
+        'frachtführer': 2, 'carrier': 1, 'absender': 1, 'übernahme des gutes': 2,
+        'kennzeichen': 1,
+    },
+}
+
+# Minimum score, and margin over the runner-up, for a text-layer decision
+MIN_SCORE = 3
+MIN_MARGIN = 2
+
+# Below this many characters a text layer is treated as absent (scanned page)
+MIN_TEXT_LENGTH = 40
+
+
+def score_text(text: str) -> Dict[str, int]:
+    text_lower = text.lower()
+    scores = {}
+    for document_type, keywords in KEYWORDS.items():
+        scores[document_type] = sum(
+            weight for keyword, weight in keywords.items()
+            if re.search(r'(?<!\w)' + re.escape(keyword) + r'(?!\w)', text_lower)
+        )
+    return scores
+
+
+def classify_text(text: Optional[str]) -> Optional[str]:
+    """Classify a page from its text layer, or None if the text is not conclusive"""
+    if not text or len(text.strip()) < MIN_TEXT_LENGTH:
+        return None
+
+    ranked = sorted(score_text(text).items(), key=lambda item: item[1], reverse=True)
+    (best, best_score), (_, runner_up) = ranked[0], ranked[1]
+    if best_score == 0:
+        # Readable text without a single known keyword
+        return OTHER
+    if best_score >= MIN_SCORE and best_score - runner_up >= MIN_MARGIN:
+        return best
+    return None
+
+
+def parse_label(response: str) -> str:
+    """Map a free-form classifier answer onto one of DOCUMENT_TYPES"""
+    response_lower = response.lower()
+    for document_type, needles in (
+        (AUSFUHRANMELDUNG, ('ausfuhranmeldung', 'export declaration', 'customs')),
+        (CMR, ('cmr', 'waybill', 'frachtbrief', 'consignment')),
+        (INVOICE, ('invoice', 'rechnung')),
+    ):
+        if any(needle in response_lower for needle in needles):
+            return document_type
+    return OTHER
+
+
+def output_formats(document_type: Optional[str]) -> Tuple[str, ...]:
+    return OUTPUT_FORMATS.get(document_type or OTHER, OUTPUT_FORMATS[OTHER])
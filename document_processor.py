@@ -1,5 +1,6 @@
 import os
-from typing import List
+import subprocess
+from typing import List, Optional
 from PIL import Image
 import asyncio
 import aiofiles
@@ -11,13 +12,13 @@ class DocumentProcessor:
     def __init__(self):
         self.supported_formats = {'.pdf', '.png', '.jpg', '.jpeg', '.docx', '.txt'}
     
-    async def process_file(self, file_path: str) -> List[Image.Image]:
+    async def process_file(self, file_path: str, resolution_scale: float = 1.0) -> List[Image.Image]:
         file_extension = os.path.splitext(file_path)[1].lower()
         
         if file_extension == '.pdf':
-            return await self._process_pdf(file_path)
+            return await self._process_pdf(file_path, resolution_scale)
         elif file_extension in {'.png', '.jpg', '.jpeg'}:
-            return await self._process_image(file_path)
+            return await self._process_image(file_path, resolution_scale)
         elif file_extension == '.docx':
             return await self._process_docx(file_path)
         elif file_extension == '.txt':
@@ -25,19 +26,55 @@ class DocumentProcessor:
         else:
             raise ValueError(f"Unsupported file format: {file_extension}")
     
-    async def _process_pdf(self, file_path: str) -> List[Image.Image]:
+    async def extract_text_pages(self, file_path: str) -> List[Optional[str]]:
+        """Text layer per page, used for cheap classification. Empty for images."""
+        file_extension = os.path.splitext(file_path)[1].lower()
+        
+        if file_extension == '.pdf':
+            def pdf_text():
+                try:
+                    output = subprocess.run(
+                        ['pdftotext', '-layout', file_path, '-'],
+                        capture_output=True, timeout=30, check=True
+                    ).stdout.decode('utf-8', errors='replace')
+                except (OSError, subprocess.SubprocessError):
+                    return []
+                # pdftotext separates pages with form feeds
+                return output.split('\f')
+            
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, pdf_text)
+        elif file_extension == '.docx':
+            def docx_text():
+                doc = Document(file_path)
+                return ['\n'.join(p.text for p in doc.paragraphs if p.text.strip())]
+            
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, docx_text)
+        elif file_extension == '.txt':
+            async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
+                return [await f.read()]
+        return []
+    
+    async def _process_pdf(self, file_path: str, resolution_scale: float = 1.0) -> List[Image.Image]:
         def convert_pdf():
-            return convert_from_path(file_path, dpi=300)
+            return convert_from_path(file_path, dpi=int(300 * resolution_scale))
         
         loop = asyncio.get_event_loop()
         images = await loop.run_in_executor(None, convert_pdf)
         return images
     
-    async def _process_image(self, file_path: str) -> List[Image.Image]:
+    async def _process_image(self, file_path: str, resolution_scale: float = 1.0) -> List[Image.Image]:
         def load_image():
             image = Image.open(file_path)
             if image.mode != 'RGB':
                 image = image.convert('RGB')
+            if resolution_scale < 1.0:
+                width, height = image.size
+                image = image.resize(
+                    (max(int(width * resolution_scale), 1), max(int(height * resolution_scale), 1)),
+                    Image.LANCZOS
+                )
             return image
         
         loop = asyncio.get_event_loop()
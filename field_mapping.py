@@ -0,0 +1,188 @@
+import hashlib
+import inspect
+import json
+from typing import Dict, Any
+
+from customs_schema import CustomsFieldMapper
+
+# Bump when the meaning of the customs/invoice output formats changes. Edits to
+# the mapping code, the pattern matching or the synonym tables are picked up by
+# the digest automatically.
+MAPPING_VERSION = "1"
+
+_mapping_version = None
+
+
+def mapping_version() -> str:
+    """Identifies the rules used for detected_field_patterns and the output formats"""
+    global _mapping_version
+    if _mapping_version is None:
+        field_mapper = CustomsFieldMapper()
+        digest = hashlib.sha256()
+        digest.update(inspect.getsource(extract_customs_fields).encode())
+        digest.update(inspect.getsource(extract_invoice_fields).encode())
+        digest.update(inspect.getsource(CustomsFieldMapper.find_matching_fields).encode())
+        digest.update(json.dumps(
+            [field_mapper.german_field_mappings, field_mapper.english_field_mappings],
+            sort_keys=True
+        ).encode())
+        _mapping_version = f"{MAPPING_VERSION}+{digest.hexdigest()[:12]}"
+    return _mapping_version
+
+
+def extract_customs_fields(extracted_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Extract and map customs declaration fields"""
+    customs_fields = {
+        # Message header
+        "nachrichtensender": {
+            "eoriNiederlassungsnummer": None
+        },
+        "nachrichtenempfanger": {
+            "dienststellennummer": None
+        },
+
+        # Header information
+        "kopf": {
+            "lrn": None,
+            "artderAnmeldung": None,
+            "artderAusfuhranmeldung": None,
+            "beteiligtenKonstellation": None,
+            "zeitpunktderAnmeldung": None,
+            "massgeblichesDatum": None,
+            "kopfDatumdesAusgangs": None,
+            "zeitpunktDerGestellung": None,
+            "zeitpunktdesEndesderLadetatigkeit": None,
+            "sicherheit": None,
+            "besondereUmstande": None,
+            "inRechnunggestellterGesamtbetrag": None,
+            "rechnungswahrung": None,
+        },
+
+        # Authorization
+        "bewilligung": {
+            "sequenznummer": None,
+            "art": None,
+            "referenznummer": None
+        },
+
+        # Customs offices
+        "gestellungszollstelle": {
+            "gestellungszollstelle": None
+        },
+        "ausfuhrzollstelle": {
+            "ausfuhrzollstelleDienststellennummer": None
+        },
+
+        # Parties
+        "anmelder": {
+            "tin": None,
+            "niederlassungsNummer": None,
+            "name": None,
+            "adresse": {
+                "strasse": None,
+                "plz": None,
+                "ort": None,
+                "land": None
+            },
+            "ansprechpartner": {
+                "ansprechName": None,
+                "phone": None,
+                "ansprechEmail": None
+            }
+        },
+
+        # Goods positions
+        "position": [],
+
+        # Additional data
+        "additional_extracted_data": {}
+    }
+
+    # Map extracted data to customs fields
+    for key, value in extracted_data.items():
+        key_lower = key.lower()
+
+        # Map LRN
+        if 'lrn' in key_lower or 'referenznummer' in key_lower:
+            customs_fields["kopf"]["lrn"] = value
+
+        # Map dates
+        elif 'datum' in key_lower:
+            if 'anmeldung' in key_lower:
+                customs_fields["kopf"]["zeitpunktderAnmeldung"] = value
+            elif 'ausgang' in key_lower:
+                customs_fields["kopf"]["kopfDatumdesAusgangs"] = value
+            else:
+                customs_fields["kopf"]["massgeblichesDatum"] = value
+
+        # Map companies
+        elif 'anmelder' in key_lower or 'declarant' in key_lower:
+            if isinstance(value, dict):
+                customs_fields["anmelder"].update(value)
+            else:
+                customs_fields["anmelder"]["name"] = value
+
+        # Map addresses
+        elif 'adresse' in key_lower or 'address' in key_lower:
+            if isinstance(value, dict):
+                customs_fields["anmelder"]["adresse"].update(value)
+
+        # Map positions/line items
+        elif 'position' in key_lower or 'line_items' in key_lower:
+            if isinstance(value, list):
+                customs_fields["position"] = value
+            else:
+                customs_fields["position"].append({"beschreibung": value})
+
+        # Store additional data
+        else:
+            customs_fields["additional_extracted_data"][key] = value
+
+    return customs_fields
+
+
+def extract_invoice_fields(extracted_data: Dict[str, Any]) -> Dict[str, Any]:
+    invoice_fields = {
+        'invoice_number': None,
+        'date': None,
+        'due_date': None,
+        'vendor_name': None,
+        'vendor_address': None,
+        'customer_name': None,
+        'customer_address': None,
+        'total_amount': None,
+        'currency': None,
+        'tax_amount': None,
+        'line_items': [],
+        'payment_terms': None
+    }
+
+    for key, value in extracted_data.items():
+        key_lower = key.lower()
+
+        if 'invoice' in key_lower and 'number' in key_lower:
+            invoice_fields['invoice_number'] = value
+        elif 'date' in key_lower and 'due' not in key_lower:
+            invoice_fields['date'] = value
+        elif 'due' in key_lower and 'date' in key_lower:
+            invoice_fields['due_date'] = value
+        elif 'vendor' in key_lower or 'seller' in key_lower:
+            if 'name' in key_lower:
+                invoice_fields['vendor_name'] = value
+            elif 'address' in key_lower:
+                invoice_fields['vendor_address'] = value
+        elif 'customer' in key_lower or 'buyer' in key_lower:
+            if 'name' in key_lower:
+                invoice_fields['customer_name'] = value
+            elif 'address' in key_lower:
+                invoice_fields['customer_address'] = value
+        elif 'total' in key_lower and 'amount' in key_lower:
+            invoice_fields['total_amount'] = value
+        elif 'currency' in key_lower:
+            invoice_fields['currency'] = value
+        elif 'tax' in key_lower:
+            invoice_fields['tax_amount'] = value
+        elif 'payment' in key_lower and 'terms' in key_lower:
+            invoice_fields['payment_terms'] = value
+
+    return invoice_fields
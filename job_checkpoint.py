@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+
+class JobCheckpoint:
+    """Per-page results of an extraction job, persisted as each page completes.
+
+    Layout under <checkpoint_dir>/<job_id>/:
+        manifest.json        page count, status, attempts and last error per page
+        page_0000.json       combined result of page 0, and so on
+    """
+
+    def __init__(self, checkpoint_dir: str, job_id: str):
+        self.job_id = job_id
+        self.directory = os.path.join(checkpoint_dir, os.path.basename(job_id))
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {
+                "job_id": self.job_id,
+                "total_pages": None,
+                "status": "new",
+                "attempts": {},
+                "errors": {},
+                "exhausted": [],
+            }
+
+    def _write_json(self, path: str, data: Dict[str, Any]):
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a truncated page
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def _page_path(self, page_number: int) -> str:
+        return os.path.join(self.directory, f"page_{page_number:04d}.json")
+
+    def save_manifest(self):
+        self.manifest["updated_at"] = datetime.now().isoformat()
+        self._write_json(self.manifest_path, self.manifest)
+
+    def start(self, total_pages: int):
+        self.manifest["total_pages"] = total_pages
+        self.manifest["status"] = "in_progress"
+        self.save_manifest()
+
+    def completed_pages(self) -> List[int]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            int(name[len("page_"):-len(".json")])
+            for name in os.listdir(self.directory)
+            if name.startswith("page_") and name.endswith(".json")
+        )
+
+    def load_page(self, page_number: int) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._page_path(page_number), 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def save_page(self, page_number: int, page_result: Dict[str, Any]):
+        self._write_json(self._page_path(page_number), page_result)
+        if self.manifest["errors"].pop(str(page_number), None) is not None:
+            self.save_manifest()
+
+    def record_failure(self, page_number: int, error: str) -> int:
+        """Count a failed attempt for a page and return its total attempts"""
+        key = str(page_number)
+        self.manifest["attempts"][key] = self.manifest["attempts"].get(key, 0) + 1
+        self.manifest["errors"][key] = error
+        self.save_manifest()
+        return self.manifest["attempts"][key]
+
+    def attempts(self, page_number: int) -> int:
+        """Failed attempts for a page across all runs of the job"""
+        return self.manifest["attempts"].get(str(page_number), 0)
+
+    def mark_exhausted(self, page_number: int):
+        """Record that a page used up its attempts and will not be retried"""
+        exhausted = self.manifest.setdefault("exhausted", [])
+        if page_number not in exhausted:
+            exhausted.append(page_number)
+            self.save_manifest()
+
+    def is_exhausted(self, page_number: int) -> bool:
+        return page_number in self.manifest.get("exhausted", [])
+
+    def reset_exhausted(self) -> List[int]:
+        """Give exhausted pages a fresh attempt budget and return them"""
+        pages = self.manifest.get("exhausted", [])
+        for page_number in pages:
+            self.manifest["attempts"].pop(str(page_number), None)
+        self.manifest["exhausted"] = []
+        self.save_manifest()
+        return pages
+
+    def error(self, page_number: int) -> Optional[str]:
+        return self.manifest["errors"].get(str(page_number))
+
+    def finish(self, status: str):
+        self.manifest["status"] = status
+        self.save_manifest()
+
+    def clear(self):
+        """Remove the checkpoint once the final result has been written"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def status(self) -> Dict[str, Any]:
+        completed = self.completed_pages()
+        return {
+            "job_id": self.job_id,
+            "status": self.manifest.get("status"),
+            "total_pages": self.manifest.get("total_pages"),
+            "completed_pages": completed,
+            "failed_pages": sorted(int(page) for page in self.manifest.get("errors", {})),
+            "exhausted_pages": sorted(self.manifest.get("exhausted", [])),
+            "errors": self.manifest.get("errors", {}),
+            "attempts": self.manifest.get("attempts", {}),
+            "updated_at": self.manifest.get("updated_at"),
+        }
+
+
+def remove_stale_checkpoints(checkpoint_dir: str, max_age_seconds: float, keep=()) -> int:
+    """Delete checkpoints not updated for max_age_seconds, except those of the jobs in keep"""
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for name in os.listdir(checkpoint_dir):
+        directory = os.path.join(checkpoint_dir, name)
+        if name in keep or not os.path.isdir(directory):
+            continue
+        try:
+            updated = os.path.getmtime(os.path.join(directory, "manifest.json"))
+        except OSError:
+            updated = os.path.getmtime(directory)
+        if updated < cutoff:
+            shutil.rmtree(directory, ignore_errors=True)
+            removed += 1
+    return removed
@@ -0,0 +1,379 @@
+"""Load-testing harness for the KIE Document Processing API.
+
+Starts the app locally with the stub model backend (unless --base-url points at
+a running server), drives /upload, /extract and /results with a configurable
+document mix, and writes a JSON report with latency percentiles, throughput,
+error rates and server RSS over time.
+
+Example:
+    python load_test.py --concurrency 8 --rate 2 --duration 60 --mix pdf:1,png:3,txt:1
+    python load_test.py --output new.json --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+import httpx
+from PIL import Image, ImageDraw
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ("upload", "extract", "results")
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest-rank method
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(','):
+        file_type, _, weight = item.partition(':')
+        weights[file_type.strip().lower()] = float(weight or 1)
+    return weights
+
+
+def create_documents(directory: str, pdf_pages: int) -> Dict[str, str]:
+    """Create one synthetic document per supported file type"""
+    def page(label: str) -> Image.Image:
+        image = Image.new('RGB', (1240, 1754), color='white')
+        draw = ImageDraw.Draw(image)
+        draw.text((60, 60), f"Ausfuhranmeldung {label}", fill='black')
+        draw.text((60, 100), "LRN: DE123456789  EORI: DE987654321000000", fill='black')
+        return image
+
+    documents = {}
+
+    documents['png'] = os.path.join(directory, 'sample.png')
+    page('png').save(documents['png'])
+
+    documents['jpg'] = os.path.join(directory, 'sample.jpg')
+    page('jpg').save(documents['jpg'], quality=85)
+
+    documents['pdf'] = os.path.join(directory, 'sample.pdf')
+    pages = [page(f'pdf {i + 1}') for i in range(pdf_pages)]
+    pages[0].save(documents['pdf'], save_all=True, append_images=pages[1:], resolution=150)
+
+    documents['txt'] = os.path.join(directory, 'sample.txt')
+    with open(documents['txt'], 'w', encoding='utf-8') as f:
+        f.write("Rechnung Nr. 2024-001\nDatum: 15.01.2024\nGesamtbetrag: 1.250,00 EUR\n")
+
+    return documents
+
+
+def read_rss(pid: int) -> Optional[int]:
+    """Resident set size of a process in bytes (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, documents: Dict[str, str]):
+        self.args = args
+        self.documents = documents
+        self.mix = {t: w for t, w in parse_mix(args.mix).items() if t in documents}
+        if not self.mix:
+            raise ValueError(f"Document mix selects no known file type: {args.mix}")
+        self.samples: List[Dict[str, Any]] = []
+        self.jobs: List[Dict[str, Any]] = []
+        self.rss: List[Dict[str, Any]] = []
+
+    async def _timed(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            response, status = None, type(e).__name__
+        self.samples.append({
+            "endpoint": endpoint,
+            "status": status,
+            "latency": time.perf_counter() - started,
+            "time": time.monotonic()
+        })
+        return response
+
+    async def run_job(self, client: httpx.AsyncClient, file_type: str, arrived: Optional[float] = None):
+        # Job latency counts from arrival, including time queued for a slot
+        started = arrived if arrived is not None else time.perf_counter()
+        job = {"file_type": file_type, "ok": False}
+        self.jobs.append(job)
+
+        path = self.documents[file_type]
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        response = await self._timed(
+            client, "upload", "POST", "/upload",
+            files={"file": (os.path.basename(path), content)}
+        )
+        if response is None or response.status_code != 200:
+            return
+        job_id = response.json()["job_id"]
+
+        response = await self._timed(client, "extract", "POST", f"/extract/{job_id}")
+        if response is None or response.status_code != 200:
+            return
+
+        response = await self._timed(client, "results", "GET", f"/results/{job_id}")
+        if response is None or response.status_code != 200:
+            return
+
+        job["ok"] = True
+        job["latency"] = time.perf_counter() - started
+
+    async def sample_rss(self, pid: Optional[int], stop: asyncio.Event, started: float):
+        while not stop.is_set():
+            if pid is not None:
+                self.rss.append({"t": round(time.monotonic() - started, 3), "rss_bytes": read_rss(pid)})
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.args.rss_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, base_url: str, server_pid: Optional[int]) -> Dict[str, Any]:
+        args = self.args
+        limits = httpx.Limits(max_connections=args.concurrency)
+        timeout = httpx.Timeout(args.timeout)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        rng = random.Random(args.seed)
+        types, weights = list(self.mix), list(self.mix.values())
+
+        stop = asyncio.Event()
+        started = time.monotonic()
+        sampler = asyncio.create_task(self.sample_rss(server_pid, stop, started))
+
+        async def guarded(client, file_type):
+            arrived = time.perf_counter()
+            async with semaphore:
+                await self.run_job(client, file_type, arrived)
+
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+            tasks = []
+            issued = 0
+            while time.monotonic() - started < args.duration:
+                if args.requests and issued >= args.requests:
+                    break
+                file_type = rng.choices(types, weights)[0]
+                if args.rate > 0:
+                    # Open loop: Poisson arrivals, queued behind the concurrency limit
+                    tasks.append(asyncio.create_task(guarded(client, file_type)))
+                    await asyncio.sleep(rng.expovariate(args.rate))
+                else:
+                    # Closed loop: keep exactly `concurrency` jobs outstanding
+                    await semaphore.acquire()
+                    task = asyncio.create_task(self.run_job(client, file_type))
+                    task.add_done_callback(lambda _: semaphore.release())
+                    tasks.append(task)
+                issued += 1
+            await asyncio.gather(*tasks)
+
+        elapsed = time.monotonic() - started
+        stop.set()
+        await sampler
+
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        endpoints = {}
+        for endpoint in ENDPOINTS:
+            samples = [s for s in self.samples if s["endpoint"] == endpoint]
+            latencies = [s["latency"] for s in samples if s["status"] == 200]
+            statuses: Dict[str, int] = {}
+            for s in samples:
+                statuses[str(s["status"])] = statuses.get(str(s["status"]), 0) + 1
+            errors = sum(count for status, count in statuses.items() if status != "200")
+            endpoints[endpoint] = {
+                "requests": len(samples),
+                "errors": errors,
+                "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+                "status_counts": statuses,
+                "throughput_rps": round(len(samples) / elapsed, 3) if elapsed else 0.0,
+                "latency_p50": percentile(latencies, 50),
+                "latency_p95": percentile(latencies, 95),
+                "latency_p99": percentile(latencies, 99),
+                "latency_max": max(latencies) if latencies else None,
+            }
+
+        completed = [job for job in self.jobs if job["ok"]]
+        job_latencies = [job["latency"] for job in completed]
+        rss_values = [point["rss_bytes"] for point in self.rss if point["rss_bytes"] is not None]
+
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "version": git_revision(),
+            "config": {
+                key: value for key, value in vars(self.args).items()
+                if key not in ("output", "compare")
+            },
+            "duration_seconds": round(elapsed, 3),
+            "jobs": {
+                "issued": len(self.jobs),
+                "completed": len(completed),
+                "failed": len(self.jobs) - len(completed),
+                "throughput_jobs_per_second": round(len(completed) / elapsed, 3) if elapsed else 0.0,
+                "latency_p50": percentile(job_latencies, 50),
+                "latency_p95": percentile(job_latencies, 95),
+                "latency_p99": percentile(job_latencies, 99),
+            },
+            "endpoints": endpoints,
+            "server_rss": {
+                "peak_bytes": max(rss_values) if rss_values else None,
+                "final_bytes": rss_values[-1] if rss_values else None,
+                "timeline": self.rss,
+            },
+        }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def wait_for_server(base_url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {process.returncode}")
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not become healthy in time")
+
+
+def start_server(port: int, workdir: str, stub_latency: float) -> subprocess.Popen:
+    env = dict(os.environ)
+    env["KIE_MODEL_BACKEND"] = "stub"
+    env["KIE_STUB_LATENCY"] = str(stub_latency)
+    # Run from a scratch directory so uploads and results stay out of the repo
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app:app",
+            "--app-dir", REPO_DIR, "--host", "127.0.0.1", "--port", str(port),
+            "--log-level", "warning"
+        ],
+        cwd=workdir,
+        env=env
+    )
+
+
+def print_summary(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    def fmt(value):
+        return "-" if value is None else f"{value * 1000:.0f}ms"
+
+    def delta(current, previous):
+        if current is None or not previous:
+            return ""
+        return f" ({(current - previous) / previous * 100:+.1f}%)"
+
+    jobs = report["jobs"]
+    base_jobs = (baseline or {}).get("jobs", {})
+    print(f"Jobs: {jobs['completed']}/{jobs['issued']} completed, "
+          f"{jobs['throughput_jobs_per_second']} jobs/s"
+          f"{delta(jobs['throughput_jobs_per_second'], base_jobs.get('throughput_jobs_per_second'))}")
+    print(f"Job latency p50={fmt(jobs['latency_p50'])} p95={fmt(jobs['latency_p95'])} "
+          f"p99={fmt(jobs['latency_p99'])}{delta(jobs['latency_p99'], base_jobs.get('latency_p99'))}")
+
+    for endpoint, stats in report["endpoints"].items():
+        base = (baseline or {}).get("endpoints", {}).get(endpoint, {})
+        print(f"  /{endpoint:<8} n={stats['requests']:<6} errors={stats['error_rate']:.2%} "
+              f"p50={fmt(stats['latency_p50'])} p95={fmt(stats['latency_p95'])} "
+              f"p99={fmt(stats['latency_p99'])}{delta(stats['latency_p99'], base.get('latency_p99'))}")
+
+    peak = report["server_rss"]["peak_bytes"]
+    if peak is not None:
+        base_peak = (baseline or {}).get("server_rss", {}).get("peak_bytes")
+        print(f"Server peak RSS: {peak / 2 ** 20:.1f} MiB{delta(peak, base_peak)}")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test the KIE Document Processing API")
+    parser.add_argument("--base-url", help="Target a running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the locally started server")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum jobs in flight")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Job arrivals per second (Poisson); 0 runs a closed loop")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to issue new jobs")
+    parser.add_argument("--requests", type=int, default=0, help="Stop after this many jobs (0 = no limit)")
+    parser.add_argument("--mix", default="pdf:1,png:2,jpg:1,txt:1",
+                        help="Document mix as type:weight pairs")
+    parser.add_argument("--pdf-pages", type=int, default=3, help="Pages in the synthetic PDF")
+    parser.add_argument("--documents", help="Directory with sample.<type> files to use instead of synthetic ones")
+    parser.add_argument("--stub-latency", type=float, default=0.5, help="Simulated inference seconds per page")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout in seconds")
+    parser.add_argument("--rss-interval", type=float, default=0.5, help="Seconds between RSS samples")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for arrivals and document mix")
+    parser.add_argument("--output", default="load_test_report.json", help="Path of the JSON report")
+    parser.add_argument("--compare", help="Previous report to compare against")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.documents:
+            documents = {
+                os.path.splitext(name)[1].lstrip('.').lower(): os.path.join(args.documents, name)
+                for name in os.listdir(args.documents) if name.startswith('sample.')
+            }
+        else:
+            documents = create_documents(workdir, args.pdf_pages)
+
+        server = None
+        base_url = args.base_url
+        if not base_url:
+            base_url = f"http://127.0.0.1:{args.port}"
+            server = start_server(args.port, workdir, args.stub_latency)
+
+        try:
+            if server is not None:
+                await wait_for_server(base_url, server, timeout=60)
+            load_test = LoadTest(args, documents)
+            report = await load_test.run(base_url, server.pid if server else None)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait(timeout=10)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_summary(report, baseline)
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
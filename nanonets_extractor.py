@@ -1,20 +1,72 @@
 import torch
-from transformers import AutoProcessor, AutoTokenizer
+from transformers import AutoProcessor, AutoTokenizer, BatchFeature
 from qwen_vl_utils import process_vision_info
 from PIL import Image
 import asyncio
-import json
-import re
-from typing import Dict, Any, List
+import os
+import threading
+from typing import Dict, Any, List, Optional
 from customs_schema import CustomsDeclarationSchema, CustomsFieldMapper
+from document_classifier import AUSFUHRANMELDUNG, INVOICE, CMR, parse_label
+from vision_cache import VisionInputCache
+import field_mapping
+import response_parser
+
+ASSISTED_DECODING_MODES = {"off", "prompt_lookup", "draft_model"}
+
+# Generation budget per document type; unclassified pages get the full budget
+MAX_NEW_TOKENS = {
+    AUSFUHRANMELDUNG: 512,
+    INVOICE: 384,
+    CMR: 320,
+}
+DEFAULT_MAX_NEW_TOKENS = 512
+
+# Longest side of the thumbnail used for document-type classification
+CLASSIFICATION_THUMBNAIL_SIZE = 448
 
 class NanoNetsExtractor:
-    def __init__(self):
+    def __init__(
+        self,
+        assisted_decoding: str = os.environ.get("KIE_ASSISTED_DECODING", "off"),
+        draft_model_name: Optional[str] = os.environ.get("KIE_DRAFT_MODEL"),
+        prompt_lookup_num_tokens: int = int(os.environ.get("KIE_PROMPT_LOOKUP_TOKENS", 10)),
+        vision_cache_dir: str = os.environ.get("KIE_VISION_CACHE_DIR", "cache/vision_inputs"),
+        vision_cache_max_bytes: int = int(os.environ.get("KIE_VISION_CACHE_MAX_BYTES", 0)),
+    ):
+        if assisted_decoding not in ASSISTED_DECODING_MODES:
+            raise ValueError(
+                f"Unknown assisted decoding mode: {assisted_decoding}. "
+                f"Allowed: {', '.join(sorted(ASSISTED_DECODING_MODES))}"
+            )
+        if assisted_decoding == "draft_model" and not draft_model_name:
+            raise ValueError("Assisted decoding with a draft model requires a draft model name")
+        
         self.model = None
+        self.draft_model = None
         self.processor = None
         self.tokenizer = None
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.field_mapper = CustomsFieldMapper()
+        
+        self.assisted_decoding = assisted_decoding
+        self.draft_model_name = draft_model_name
+        self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+        
+        # Created in initialize(), so mapping-only instances never touch the disk;
+        # a size limit of 0 (the default) disables the cache. An entry for a
+        # 300-dpi A4 page takes about 100 MB in bfloat16.
+        self.vision_cache_dir = vision_cache_dir
+        self.vision_cache_max_bytes = vision_cache_max_bytes
+        self.vision_cache: Optional[VisionInputCache] = None
+        self._vision_fingerprint = None
+        
+        # Main-model forward passes and drafted tokens are counted per inference
+        # thread; every verification pass yields one token of its own, so any
+        # further tokens produced in that pass were accepted from the drafter.
+        self._forward_counter = threading.local()
+        self._stats_lock = threading.Lock()
+        self._decoding_totals = {"generated_tokens": 0, "forward_passes": 0, "drafted_tokens": 0, "pages": 0}
     
     async def initialize(self):
         def load_model():
@@ -33,30 +85,150 @@ class NanoNetsExtractor:
             processor = AutoProcessor.from_pretrained(model_name)
             tokenizer = AutoTokenizer.from_pretrained(model_name)
             
-            return model, processor, tokenizer
+            draft_model = None
+            if self.assisted_decoding == "draft_model":
+                # The draft model must share the main model's tokenizer
+                draft_model = Qwen2VLForConditionalGeneration.from_pretrained(
+                    self.draft_model_name,
+                    device_map="auto",
+                    torch_dtype="auto"
+                )
+            
+            return model, processor, tokenizer, draft_model
         
         loop = asyncio.get_event_loop()
-        self.model, self.processor, self.tokenizer = await loop.run_in_executor(None, load_model)
-        print(f"NanoNets model loaded on {self.device}")
+        self.model, self.processor, self.tokenizer, self.draft_model = await loop.run_in_executor(None, load_model)
+        self.model.register_forward_hook(self._count_forward_pass)
+        self._count_drafted_tokens()
+        
+        if self.vision_cache_max_bytes > 0:
+            self.vision_cache = VisionInputCache(self.vision_cache_dir, self.vision_cache_max_bytes)
+            self._vision_fingerprint = self._preprocessing_fingerprint()
+        print(f"NanoNets model loaded on {self.device} (assisted decoding: {self.assisted_decoding})")
+    
+    def _preprocessing_fingerprint(self) -> str:
+        """Identifies everything that shapes the vision tensors besides the page itself"""
+        try:
+            from importlib.metadata import version
+            vision_utils_version = version("qwen-vl-utils")
+        except Exception:
+            vision_utils_version = "unknown"
+        return f"{vision_utils_version}|{self.model.dtype}|{self.processor.image_processor.to_json_string()}"
     
-    async def extract_key_value_pairs(self, image: Image.Image) -> Dict[str, Any]:
-        prompt = self._create_extraction_prompt()
+    def vision_cache_stats(self) -> Dict[str, Any]:
+        if self.vision_cache is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.vision_cache.stats()}
+    
+    def _prepare_inputs(self, image: Image.Image, messages: List[Dict[str, Any]], text: str) -> BatchFeature:
+        """Processor inputs, reusing cached pixel_values/image_grid_thw for known pages"""
+        key = self.vision_cache.key(image, self._vision_fingerprint)
+        vision = self.vision_cache.get(key)
         
-        def inference():
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image", "image": image},
-                        {"type": "text", "text": prompt}
-                    ]
-                }
-            ]
+        if vision is None:
+            image_inputs, _ = process_vision_info(messages)
+            vision = dict(self.processor.image_processor(images=image_inputs, return_tensors="pt"))
+            # The vision tower casts pixel_values to the model dtype on entry, so
+            # casting here leaves the output unchanged and halves the entry for bf16
+            vision["pixel_values"] = vision["pixel_values"].to(self.model.dtype)
+            self.vision_cache.put_async(key, vision)
+        
+        # Expand the image placeholder to one token per merged patch, as the
+        # processor does when it is given the image itself.
+        merge_length = self.processor.image_processor.merge_size ** 2
+        num_image_tokens = int(vision["image_grid_thw"][0].prod()) // merge_length
+        text = text.replace("<|image_pad|>", "<|image_pad|>" * num_image_tokens, 1)
+        
+        text_inputs = self.processor.tokenizer([text], padding=True, return_tensors="pt")
+        return BatchFeature(data={**text_inputs, **vision})
+    
+    def _count_forward_pass(self, module, args, output):
+        self._forward_counter.count = getattr(self._forward_counter, "count", 0) + 1
+    
+    def _count_drafted_tokens(self):
+        """Wrap the candidate generators created by generate() to count proposed tokens"""
+        get_candidate_generator = self.model._get_candidate_generator
+        
+        def counting_candidate_generator(*args, **kwargs):
+            candidate_generator = get_candidate_generator(*args, **kwargs)
+            get_candidates = candidate_generator.get_candidates
             
-            text = self.processor.apply_chat_template(
-                messages, tokenize=False, add_generation_prompt=True
-            )
+            def counted_get_candidates(input_ids, *candidate_args, **candidate_kwargs):
+                candidate_ids, candidate_logits = get_candidates(input_ids, *candidate_args, **candidate_kwargs)
+                drafted = candidate_ids.shape[-1] - input_ids.shape[-1]
+                self._forward_counter.drafted = getattr(self._forward_counter, "drafted", 0) + drafted
+                return candidate_ids, candidate_logits
             
+            candidate_generator.get_candidates = counted_get_candidates
+            return candidate_generator
+        
+        # generate() looks the factory up on the instance, so this shadows the method
+        self.model._get_candidate_generator = counting_candidate_generator
+    
+    def _assisted_generation_kwargs(self) -> Dict[str, Any]:
+        if self.assisted_decoding == "prompt_lookup":
+            # Drafts n-grams from the prompt itself, which contains the example
+            # JSON and German field names the answer mostly repeats.
+            return {"prompt_lookup_num_tokens": self.prompt_lookup_num_tokens}
+        if self.assisted_decoding == "draft_model":
+            return {"assistant_model": self.draft_model}
+        return {}
+    
+    @staticmethod
+    def _decoding_rates(generated_tokens: int, forward_passes: int, drafted_tokens: int) -> Dict[str, Any]:
+        accepted = max(generated_tokens - forward_passes, 0)
+        return {
+            "accepted_draft_tokens": accepted,
+            # Accepted over proposed draft tokens, the figure to tune the drafter by
+            "acceptance_rate": round(accepted / drafted_tokens, 4) if drafted_tokens else 0.0,
+            # Share of the output that came from drafts
+            "draft_token_share": round(accepted / generated_tokens, 4) if generated_tokens else 0.0,
+        }
+    
+    def _record_decoding(self, generated_tokens: int, forward_passes: int, drafted_tokens: int) -> Dict[str, Any]:
+        with self._stats_lock:
+            self._decoding_totals["generated_tokens"] += generated_tokens
+            self._decoding_totals["forward_passes"] += forward_passes
+            self._decoding_totals["drafted_tokens"] += drafted_tokens
+            self._decoding_totals["pages"] += 1
+        
+        return {
+            "mode": self.assisted_decoding,
+            "generated_tokens": generated_tokens,
+            "forward_passes": forward_passes,
+            "drafted_tokens": drafted_tokens,
+            **self._decoding_rates(generated_tokens, forward_passes, drafted_tokens)
+        }
+    
+    def decoding_stats(self) -> Dict[str, Any]:
+        """Cumulative decoding statistics since startup"""
+        with self._stats_lock:
+            totals = dict(self._decoding_totals)
+        
+        totals["mode"] = self.assisted_decoding
+        totals.update(self._decoding_rates(
+            totals["generated_tokens"], totals["forward_passes"], totals["drafted_tokens"]
+        ))
+        return totals
+    
+    def _generate(self, image: Image.Image, prompt: str, max_new_tokens: int, **generate_kwargs):
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": image},
+                    {"type": "text", "text": prompt}
+                ]
+            }
+        ]
+        
+        text = self.processor.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        )
+        
+        if self.vision_cache is not None:
+            inputs = self._prepare_inputs(image, messages, text)
+        else:
             image_inputs, video_inputs = process_vision_info(messages)
             
             inputs = self.processor(
@@ -66,33 +238,77 @@ class NanoNetsExtractor:
                 padding=True,
                 return_tensors="pt"
             )
-            
-            inputs = inputs.to(self.device)
-            
-            with torch.no_grad():
-                generated_ids = self.model.generate(
-                    **inputs,
-                    max_new_tokens=512,
-                    do_sample=False,
-                    temperature=0.1
-                )
-            
-            generated_ids_trimmed = [
-                out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-            ]
-            
-            response = self.processor.batch_decode(
-                generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-            )[0]
-            
+        
+        inputs = inputs.to(self.device)
+        
+        with torch.no_grad():
+            generated_ids = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                temperature=0.1,
+                **generate_kwargs
+            )
+        
+        generated_ids_trimmed = [
+            out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+        ]
+        
+        response = self.processor.batch_decode(
+            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )[0]
+        
+        return response, len(generated_ids_trimmed[0])
+    
+    async def classify_document(self, image: Image.Image) -> str:
+        """Label a page as one of the document types from a downscaled thumbnail"""
+        thumbnail = image.copy()
+        thumbnail.thumbnail((CLASSIFICATION_THUMBNAIL_SIZE, CLASSIFICATION_THUMBNAIL_SIZE))
+        prompt = (
+            "What type of document is this? Answer with exactly one word: "
+            "Ausfuhranmeldung, Invoice, CMR or Other."
+        )
+        
+        def inference():
+            response, _ = self._generate(thumbnail, prompt, max_new_tokens=8)
             return response
         
         loop = asyncio.get_event_loop()
-        raw_response = await loop.run_in_executor(None, inference)
+        response = await loop.run_in_executor(None, inference)
+        return parse_label(response)
+    
+    async def extract_key_value_pairs(self, image: Image.Image, document_type: Optional[str] = None) -> Dict[str, Any]:
+        prompt = self._create_extraction_prompt(document_type)
+        max_new_tokens = MAX_NEW_TOKENS.get(document_type, DEFAULT_MAX_NEW_TOKENS)
+        
+        def inference():
+            self._forward_counter.count = 0
+            self._forward_counter.drafted = 0
+            # Assisted generation verifies drafts against the main model's
+            # greedy choice, so the output matches plain greedy decoding.
+            response, generated_tokens = self._generate(
+                image, prompt, max_new_tokens, **self._assisted_generation_kwargs()
+            )
+            decoding = self._record_decoding(
+                generated_tokens, self._forward_counter.count, self._forward_counter.drafted
+            )
+            return response, decoding
+        
+        loop = asyncio.get_event_loop()
+        raw_response, decoding = await loop.run_in_executor(None, inference)
         
-        return self._parse_response(raw_response)
+        result = self._parse_response(raw_response)
+        if "extraction_metadata" in result:
+            result["extraction_metadata"]["decoding"] = decoding
+        return result
     
-    def _create_extraction_prompt(self) -> str:
+    def _create_extraction_prompt(self, document_type: Optional[str] = None) -> str:
+        if document_type == AUSFUHRANMELDUNG:
+            return self._create_customs_prompt()
+        if document_type == INVOICE:
+            return self._create_invoice_prompt()
+        if document_type == CMR:
+            return self._create_cmr_prompt()
         return """Extract all key-value pairs from this German customs export declaration (Ausfuhranmeldung) or related document. Focus on:
 
 PRIORITY FIELDS (German customs export declaration):
@@ -155,207 +371,66 @@ Example structure:
     }
 }"""
     
-    def _parse_response(self, response: str) -> Dict[str, Any]:
-        try:
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(0)
-                parsed_data = json.loads(json_str)
-                
-                # Enhance with field mapping
-                enhanced_data = self._enhance_with_field_mapping(parsed_data, response)
-                return enhanced_data
-            else:
-                return self._fallback_parse(response)
-        except json.JSONDecodeError:
-            return self._fallback_parse(response)
+    def _create_customs_prompt(self) -> str:
+        return """Extract all fields from this German customs export declaration (Ausfuhranmeldung) as JSON. Preserve German text exactly, keep dates in original format, use German field names.
+
+Fields: LRN, MRN, EORI-Nummer, Anmeldedatum, Ausgangsdatum, Anmelder/Ausführer/Empfänger (Name, Adresse), Zollstellen, Bewilligung, Positionen (Warenbezeichnung, Warennummer, Ursprungsland, Menge, Rohmasse, Eigenmasse, Wert), Währung, Verkehrszweig, Kennzeichen, Besondere Umstände.
+
+Example:
+{
+    "document_type": "Ausfuhranmeldung",
+    "lrn": "DE123456789",
+    "mrn": "24DE...",
+    "kopf": {"anmeldedatum": "2024-01-15"},
+    "anmelder": {"name": "Firma XYZ GmbH", "eori": "DE...", "adresse": {"strasse": "...", "plz": "...", "ort": "...", "land": "DE"}},
+    "position": [{"warenbezeichnung": "...", "warennummer": "...", "menge": "...", "wert": "..."}]
+}"""
     
-    def _fallback_parse(self, response: str) -> Dict[str, Any]:
-        lines = response.strip().split('\n')
-        result = {"raw_text": response}
-        
-        for line in lines:
-            if ':' in line:
-                key, value = line.split(':', 1)
-                key = key.strip().lower().replace(' ', '_')
-                value = value.strip()
-                if value:
-                    result[key] = value
-        
-        return result
+    def _create_invoice_prompt(self) -> str:
+        return """Extract all fields from this invoice (Rechnung) as JSON. Preserve text exactly and keep dates in original format.
+
+Example:
+{
+    "document_type": "Invoice",
+    "invoice_number": "...",
+    "invoice_date": "...",
+    "due_date": "...",
+    "vendor_name": "...",
+    "vendor_address": "...",
+    "customer_name": "...",
+    "customer_address": "...",
+    "line_items": [{"description": "...", "quantity": "...", "unit_price": "...", "total": "..."}],
+    "tax_amount": "...",
+    "total_amount": "...",
+    "currency": "EUR",
+    "payment_terms": "..."
+}"""
     
-    def _enhance_with_field_mapping(self, parsed_data: Dict[str, Any], raw_response: str) -> Dict[str, Any]:
-        """Enhance parsed data with field mapping and pattern matching"""
-        enhanced_data = parsed_data.copy()
-        
-        # Find potential field matches in raw response
-        field_matches = self.field_mapper.find_matching_fields(raw_response)
-        
-        if field_matches:
-            enhanced_data["detected_field_patterns"] = field_matches
-        
-        # Add metadata
-        enhanced_data["extraction_metadata"] = {
-            "model_used": "nanonets-ocr-s",
-            "extraction_timestamp": "2024-01-15T10:00:00Z",
-            "field_mapping_applied": True,
-            "total_fields_detected": len(field_matches) if field_matches else 0
-        }
-        
-        return enhanced_data
+    def _create_cmr_prompt(self) -> str:
+        return """Extract all fields from this CMR consignment note / waybill (Frachtbrief) as JSON. Preserve German text exactly and keep dates in original format.
+
+Example:
+{
+    "document_type": "CMR",
+    "cmr_nummer": "...",
+    "versender": {"name": "...", "adresse": "..."},
+    "empfanger": {"name": "...", "adresse": "..."},
+    "frachtfuhrer": {"name": "...", "kennzeichen": "..."},
+    "ort_der_ubernahme": "...",
+    "ort_der_ablieferung": "...",
+    "datum": "...",
+    "position": [{"warenbezeichnung": "...", "anzahl_packstucke": "...", "rohmasse": "..."}]
+}"""
+    
+    def _parse_response(self, response: str) -> Dict[str, Any]:
+        return response_parser.parse_response(response)
+    
+    def mapping_version(self) -> str:
+        return field_mapping.mapping_version()
     
     def extract_customs_fields(self, extracted_data: Dict[str, Any]) -> Dict[str, Any]:
         """Extract and map customs declaration fields"""
-        customs_fields = {
-            # Message header
-            "nachrichtensender": {
-                "eoriNiederlassungsnummer": None
-            },
-            "nachrichtenempfanger": {
-                "dienststellennummer": None
-            },
-            
-            # Header information
-            "kopf": {
-                "lrn": None,
-                "artderAnmeldung": None,
-                "artderAusfuhranmeldung": None,
-                "beteiligtenKonstellation": None,
-                "zeitpunktderAnmeldung": None,
-                "massgeblichesDatum": None,
-                "kopfDatumdesAusgangs": None,
-                "zeitpunktDerGestellung": None,
-                "zeitpunktdesEndesderLadetatigkeit": None,
-                "sicherheit": None,
-                "besondereUmstande": None,
-                "inRechnunggestellterGesamtbetrag": None,
-                "rechnungswahrung": None,
-            },
-            
-            # Authorization
-            "bewilligung": {
-                "sequenznummer": None,
-                "art": None,
-                "referenznummer": None
-            },
-            
-            # Customs offices
-            "gestellungszollstelle": {
-                "gestellungszollstelle": None
-            },
-            "ausfuhrzollstelle": {
-                "ausfuhrzollstelleDienststellennummer": None
-            },
-            
-            # Parties
-            "anmelder": {
-                "tin": None,
-                "niederlassungsNummer": None,
-                "name": None,
-                "adresse": {
-                    "strasse": None,
-                    "plz": None,
-                    "ort": None,
-                    "land": None
-                },
-                "ansprechpartner": {
-                    "ansprechName": None,
-                    "phone": None,
-                    "ansprechEmail": None
-                }
-            },
-            
-            # Goods positions
-            "position": [],
-            
-            # Additional data
-            "additional_extracted_data": {}
-        }
-        
-        # Map extracted data to customs fields
-        for key, value in extracted_data.items():
-            key_lower = key.lower()
-            
-            # Map LRN
-            if 'lrn' in key_lower or 'referenznummer' in key_lower:
-                customs_fields["kopf"]["lrn"] = value
-            
-            # Map dates
-            elif 'datum' in key_lower:
-                if 'anmeldung' in key_lower:
-                    customs_fields["kopf"]["zeitpunktderAnmeldung"] = value
-                elif 'ausgang' in key_lower:
-                    customs_fields["kopf"]["kopfDatumdesAusgangs"] = value
-                else:
-                    customs_fields["kopf"]["massgeblichesDatum"] = value
-            
-            # Map companies
-            elif 'anmelder' in key_lower or 'declarant' in key_lower:
-                if isinstance(value, dict):
-                    customs_fields["anmelder"].update(value)
-                else:
-                    customs_fields["anmelder"]["name"] = value
-            
-            # Map addresses
-            elif 'adresse' in key_lower or 'address' in key_lower:
-                if isinstance(value, dict):
-                    customs_fields["anmelder"]["adresse"].update(value)
-            
-            # Map positions/line items
-            elif 'position' in key_lower or 'line_items' in key_lower:
-                if isinstance(value, list):
-                    customs_fields["position"] = value
-                else:
-                    customs_fields["position"].append({"beschreibung": value})
-            
-            # Store additional data
-            else:
-                customs_fields["additional_extracted_data"][key] = value
-        
-        return customs_fields
+        return field_mapping.extract_customs_fields(extracted_data)
     
     def extract_invoice_fields(self, extracted_data: Dict[str, Any]) -> Dict[str, Any]:
-        invoice_fields = {
-            'invoice_number': None,
-            'date': None,
-            'due_date': None,
-            'vendor_name': None,
-            'vendor_address': None,
-            'customer_name': None,
-            'customer_address': None,
-            'total_amount': None,
-            'currency': None,
-            'tax_amount': None,
-            'line_items': [],
-            'payment_terms': None
-        }
-        
-        for key, value in extracted_data.items():
-            key_lower = key.lower()
-            
-            if 'invoice' in key_lower and 'number' in key_lower:
-                invoice_fields['invoice_number'] = value
-            elif 'date' in key_lower and 'due' not in key_lower:
-                invoice_fields['date'] = value
-            elif 'due' in key_lower and 'date' in key_lower:
-                invoice_fields['due_date'] = value
-            elif 'vendor' in key_lower or 'seller' in key_lower:
-                if 'name' in key_lower:
-                    invoice_fields['vendor_name'] = value
-                elif 'address' in key_lower:
-                    invoice_fields['vendor_address'] = value
-            elif 'customer' in key_lower or 'buyer' in key_lower:
-                if 'name' in key_lower:
-                    invoice_fields['customer_name'] = value
-                elif 'address' in key_lower:
-                    invoice_fields['customer_address'] = value
-            elif 'total' in key_lower and 'amount' in key_lower:
-                invoice_fields['total_amount'] = value
-            elif 'currency' in key_lower:
-                invoice_fields['currency'] = value
-            elif 'tax' in key_lower:
-                invoice_fields['tax_amount'] = value
-            elif 'payment' in key_lower and 'terms' in key_lower:
-                invoice_fields['payment_terms'] = value
-        
-        return invoice_fields
+        return field_mapping.extract_invoice_fields(extracted_data)
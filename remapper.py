@@ -0,0 +1,147 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+# Only torch-free modules: spawned workers import this module and nothing heavier
+import field_mapping
+import response_parser
+from document_classifier import output_formats
+
+RESULTS_SUFFIX = "_results.json"
+
+# Files per worker task; batches smaller than this are remapped in-process
+CHUNK_SIZE = 256
+
+
+def remap_result(result_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Rebuild the field patterns and output formats of a stored result from its raw extraction"""
+    for page_result in result_data.get("extracted_data", []):
+        if page_result.get("exhausted"):
+            continue
+        raw_extraction = page_result.get("raw_extraction") or {}
+        # Synonym-table changes reach detected_field_patterns, which the
+        # mappings below also see, as at extraction time
+        response_parser.refresh_field_patterns(raw_extraction)
+        # Pages without a document class predate classification and keep both formats
+        formats = output_formats(page_result.get("document_class"))
+        if "customs_format" in formats:
+            page_result["customs_format"] = field_mapping.extract_customs_fields(raw_extraction)
+        if "invoice_format" in formats:
+            page_result["invoice_format"] = field_mapping.extract_invoice_fields(raw_extraction)
+
+    result_data["mapping_version"] = field_mapping.mapping_version()
+    result_data["remapped_at"] = datetime.now().isoformat()
+    return result_data
+
+
+def remap_files(paths: List[str], force: bool) -> List[Tuple[str, str, Any]]:
+    """Remap result files in place. Returns (status, job_id, result data or error) per file"""
+    version = field_mapping.mapping_version()
+    outcomes = []
+
+    for path in paths:
+        job_id = os.path.basename(path)[:-len(RESULTS_SUFFIX)]
+        try:
+            with open(path, 'r') as f:
+                result_data = json.load(f)
+
+            if not force and result_data.get("mapping_version") == version:
+                outcomes.append(("skipped", job_id, None))
+                continue
+
+            remap_result(result_data)
+
+            # Write to a temporary file first so readers never see a partial result
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(result_data, f, indent=2)
+            os.replace(tmp_path, path)
+
+            outcomes.append(("remapped", job_id, result_data))
+        except Exception as e:
+            outcomes.append(("failed", job_id, str(e)))
+
+    return outcomes
+
+
+class Remapper:
+    """Re-applies the current field mapping to stored results without inference"""
+
+    def __init__(self, results_dir: str, max_workers: Optional[int] = None):
+        self.results_dir = results_dir
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Spawned workers do not inherit the parent's model or CUDA state
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def result_paths(self, job_ids: Optional[List[str]] = None) -> List[str]:
+        # Only an omitted list means every job; an empty list selects none
+        if job_ids is not None:
+            return [
+                os.path.join(self.results_dir, f"{os.path.basename(job_id)}{RESULTS_SUFFIX}")
+                for job_id in job_ids
+            ]
+        return [
+            os.path.join(self.results_dir, name)
+            for name in os.listdir(self.results_dir)
+            if name.endswith(RESULTS_SUFFIX)
+        ]
+
+    def remap(self, job_ids: Optional[List[str]] = None, force: bool = False, index=None) -> Dict[str, Any]:
+        """Remap the given jobs, or every stored job when job_ids is None"""
+        started = time.monotonic()
+        paths = self.result_paths(job_ids)
+
+        missing = [path for path in paths if not os.path.exists(path)]
+        paths = [path for path in paths if os.path.exists(path)]
+
+        if len(paths) <= CHUNK_SIZE:
+            chunks_outcomes = [remap_files(paths, force)]
+        else:
+            pool = self._get_pool()
+            chunks = [paths[i:i + CHUNK_SIZE] for i in range(0, len(paths), CHUNK_SIZE)]
+            chunks_outcomes = pool.map(remap_files, chunks, [force] * len(chunks))
+
+        summary = {
+            "mapping_version": field_mapping.mapping_version(),
+            "remapped": 0,
+            "skipped": 0,
+            "failed": [
+                {"job_id": os.path.basename(path)[:-len(RESULTS_SUFFIX)], "error": "Results not found"}
+                for path in missing
+            ],
+        }
+
+        for outcomes in chunks_outcomes:
+            remapped = []
+            for status, job_id, payload in outcomes:
+                if status == "remapped":
+                    remapped.append(payload)
+                elif status == "skipped":
+                    summary["skipped"] += 1
+                else:
+                    summary["failed"].append({"job_id": job_id, "error": payload})
+            summary["remapped"] += len(remapped)
+            if index is not None and remapped:
+                index.index_results(remapped)
+
+        elapsed = time.monotonic() - started
+        summary["elapsed_seconds"] = round(elapsed, 3)
+        summary["jobs_per_second"] = round((summary["remapped"] + summary["skipped"]) / elapsed, 1) if elapsed else 0.0
+        return summary
@@ -0,0 +1,83 @@
+import json
+import re
+from typing import Dict, Any
+
+# Torch-free, so the stub backend and remap workers can parse without the model stack
+from customs_schema import CustomsFieldMapper
+
+_field_mapper = CustomsFieldMapper()
+
+
+def parse_response(response: str) -> Dict[str, Any]:
+    """Parse a model response into a dict, falling back to "key: value" lines"""
+    try:
+        json_match = re.search(r'\{.*\}', response, re.DOTALL)
+        if json_match:
+            json_str = json_match.group(0)
+            parsed_data = json.loads(json_str)
+
+            # Enhance with field mapping
+            enhanced_data = enhance_with_field_mapping(parsed_data, response)
+            return enhanced_data
+        else:
+            return fallback_parse(response)
+    except json.JSONDecodeError:
+        return fallback_parse(response)
+
+
+def fallback_parse(response: str) -> Dict[str, Any]:
+    lines = response.strip().split('\n')
+    result = {"raw_text": response}
+
+    for line in lines:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            key = key.strip().lower().replace(' ', '_')
+            value = value.strip()
+            if value:
+                result[key] = value
+
+    return result
+
+
+def enhance_with_field_mapping(parsed_data: Dict[str, Any], raw_response: str) -> Dict[str, Any]:
+    """Enhance parsed data with field mapping and pattern matching"""
+    enhanced_data = parsed_data.copy()
+
+    # Find potential field matches in raw response
+    field_matches = _field_mapper.find_matching_fields(raw_response)
+
+    if field_matches:
+        enhanced_data["detected_field_patterns"] = field_matches
+
+    # Add metadata
+    enhanced_data["extraction_metadata"] = {
+        "model_used": "nanonets-ocr-s",
+        "extraction_timestamp": "2024-01-15T10:00:00Z",
+        "field_mapping_applied": True,
+        "total_fields_detected": len(field_matches) if field_matches else 0,
+        # Kept so that /remap can recompute detected_field_patterns without inference
+        "raw_response": raw_response
+    }
+
+    return enhanced_data
+
+
+def refresh_field_patterns(extracted_data: Dict[str, Any]) -> bool:
+    """Recompute detected_field_patterns from the stored raw response.
+
+    Returns False for extractions stored without their raw response, whose
+    patterns cannot be rebuilt.
+    """
+    metadata = extracted_data.get("extraction_metadata") or {}
+    raw_response = metadata.get("raw_response")
+    if raw_response is None:
+        return False
+
+    field_matches = _field_mapper.find_matching_fields(raw_response)
+    if field_matches:
+        extracted_data["detected_field_patterns"] = field_matches
+    else:
+        extracted_data.pop("detected_field_patterns", None)
+    metadata["total_fields_detected"] = len(field_matches)
+    return True
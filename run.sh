@@ -28,4 +28,4 @@ fi
 
 # Start the application
 echo "Starting the application on http://localhost:8000"
-python app.py
\ No newline at end of file
+python server.py
\ No newline at end of file
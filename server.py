@@ -0,0 +1,10 @@
+"""Entry point for the API server: python server.py
+
+Kept separate from app.py because multiprocessing re-imports the __main__
+module in every spawned worker (see remapper.py); this module is cheap to
+re-import, app.py with its module-level setup is not.
+"""
+import uvicorn
+
+if __name__ == "__main__":
+    uvicorn.run("app:app", host="0.0.0.0", port=8000)
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import os
+import time
+from typing import Dict, Any, Optional
+from PIL import Image
+
+# Torch-free imports only, so load tests run without the model stack installed
+import field_mapping
+import response_parser
+from document_classifier import AUSFUHRANMELDUNG
+
+STUB_RESPONSE = {
+    "document_type": "Ausfuhranmeldung",
+    "lrn": "DE123456789",
+    "kopf": {
+        "anmeldedatum": "2024-01-15",
+        "artderAnmeldung": "EX"
+    },
+    "anmelder": {
+        "name": "Firma XYZ GmbH",
+        "adresse": {
+            "strasse": "Musterstraße 123",
+            "plz": "12345",
+            "ort": "Berlin",
+            "land": "DE"
+        }
+    },
+    "position": [
+        {
+            "warenbezeichnung": "Maschinenbauteile",
+            "menge": "100",
+            "wert": "50000.00"
+        }
+    ]
+}
+
+
+class StubExtractor:
+    """Model-free extractor for load testing.
+
+    Provides the NanoNetsExtractor interface without loading a model: every
+    page is answered with a fixed response after a simulated inference delay,
+    while the parsing and field mapping stay real.
+    """
+
+    def __init__(self):
+        # Seconds per page, plus seconds per megapixel of the page image
+        self.page_latency = float(os.environ.get("KIE_STUB_LATENCY", 0.5))
+        self.megapixel_latency = float(os.environ.get("KIE_STUB_MEGAPIXEL_LATENCY", 0.02))
+
+    async def initialize(self):
+        print("Stub extractor initialized (no model loaded)")
+
+    async def classify_document(self, image: Image.Image) -> str:
+        def inference():
+            time.sleep(self.page_latency / 10)
+            return AUSFUHRANMELDUNG
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, inference)
+
+    async def extract_key_value_pairs(self, image: Image.Image, document_type: Optional[str] = None) -> Dict[str, Any]:
+        def inference():
+            width, height = image.size
+            # Blocking sleep, like real inference occupying an executor thread
+            time.sleep(self.page_latency + width * height / 1_000_000 * self.megapixel_latency)
+            return json.dumps(STUB_RESPONSE, ensure_ascii=False)
+
+        loop = asyncio.get_event_loop()
+        raw_response = await loop.run_in_executor(None, inference)
+
+        return response_parser.parse_response(raw_response)
+
+    def mapping_version(self) -> str:
+        return field_mapping.mapping_version()
+
+    def extract_customs_fields(self, extracted_data: Dict[str, Any]) -> Dict[str, Any]:
+        return field_mapping.extract_customs_fields(extracted_data)
+
+    def extract_invoice_fields(self, extracted_data: Dict[str, Any]) -> Dict[str, Any]:
+        return field_mapping.extract_invoice_fields(extracted_data)
+
+    def decoding_stats(self) -> Dict[str, Any]:
+        return {"mode": "stub"}
+
+    def vision_cache_stats(self) -> Dict[str, Any]:
+        return {"enabled": False}
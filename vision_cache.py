@@ -0,0 +1,146 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import torch
+from PIL import Image
+from safetensors.torch import save_file, load_file
+
+CACHE_SUFFIX = ".safetensors"
+
+# Entries waiting for the background writer; further puts are dropped meanwhile,
+# so a slow disk never holds more than this many entries in memory
+MAX_PENDING_WRITES = 2
+
+
+class VisionInputCache:
+    """On-disk LRU cache of preprocessed vision tensors (pixel_values, image_grid_thw).
+
+    Entries are safetensors files, which are memory-mapped on load. The file
+    modification time doubles as the last-access time for LRU eviction. New
+    entries are written by a background thread, off the inference path.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dropped_writes = 0
+        self._pending = set()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vision-cache")
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # key -> (size in bytes, last access time), rebuilt from disk on startup
+        self._entries: Dict[str, list] = {}
+        for name in os.listdir(cache_dir):
+            if name.endswith(CACHE_SUFFIX):
+                stat = os.stat(os.path.join(cache_dir, name))
+                self._entries[name[:-len(CACHE_SUFFIX)]] = [stat.st_size, stat.st_mtime]
+        self._total_bytes = sum(size for size, _ in self._entries.values())
+
+    @staticmethod
+    def key(image: Image.Image, fingerprint: str) -> str:
+        """Cache key from the page pixels and the preprocessing configuration"""
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(fingerprint.encode())
+        digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    def get(self, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        path = self._path(key)
+        try:
+            tensors = load_file(path, device="cpu")
+        except Exception:
+            with self._lock:
+                self.misses += 1
+                self._forget(key)
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries[key][1] = time.time()
+        return tensors
+
+    def put(self, key: str, tensors: Dict[str, torch.Tensor]):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            save_file({name: tensor.contiguous().cpu() for name, tensor in tensors.items()}, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = [size, os.path.getmtime(path)]
+            self._total_bytes += size
+            self._evict()
+
+    def put_async(self, key: str, tensors: Dict[str, torch.Tensor]):
+        """Queue an entry for the background writer; the tensors must not be modified afterwards"""
+        with self._lock:
+            if key in self._pending:
+                return
+            if len(self._pending) >= MAX_PENDING_WRITES:
+                self.dropped_writes += 1
+                return
+            self._pending.add(key)
+        self._writer.submit(self._write, key, tensors)
+
+    def _write(self, key: str, tensors: Dict[str, torch.Tensor]):
+        try:
+            self.put(key, tensors)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _forget(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry[0]
+
+    def _evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        for key, _ in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._forget(key)
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "pending_writes": len(self._pending),
+                "dropped_writes": self.dropped_writes,
+            }